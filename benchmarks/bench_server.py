@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+压测使用的服务端，按场景启动
+每个group注册一个 cmd=group_id 的路由，原样返回body
+
+python bench_server.py <scenario> [port]
+"""
+
+import sys
+sys.path.insert(0, '../')
+
+from netkit.box import Box
+
+from melon import Melon
+from scenarios import SCENARIOS
+
+
+def create_app(scenario):
+    conf = SCENARIOS[scenario]['server']
+    groups = conf['groups']
+
+    class BenchMelon(Melon):
+        pass
+
+    for name, value in (conf.get('app_attrs') or dict()).items():
+        setattr(BenchMelon, name, value)
+
+    app = BenchMelon(Box, groups, lambda box: box.cmd if box.cmd in groups else groups.keys()[0])
+
+    def echo(request):
+        request.write(dict(ret=0, body=request.box.body))
+
+    for group_id in groups:
+        app.add_route_rule(group_id, echo, 'echo_%s' % group_id)
+
+    return app
+
+
+def main():
+    scenario = sys.argv[1]
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 7900
+
+    app = create_app(scenario)
+    app.run('127.0.0.1', port, frontend=SCENARIOS[scenario]['server'].get('frontend'))
+
+
+if __name__ == '__main__':
+    main()
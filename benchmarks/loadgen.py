@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+melon 的压测客户端
+
+多进程、每个进程多个连接，每个连接保持 depth 个未返回的请求:
+    pipeline:   每个连接同时有 depth 个请求在途，收到一个返回就补发一个
+    closed:     每个连接同一时间只有1个请求，收到返回之后才发下一个(即 depth=1)
+
+结果以json输出，包括吞吐和 p50/p99/p999 延迟
+
+python loadgen.py --port 7900 --connections 16 --depth 8 --body-len 32 --duration 10
+"""
+
+import sys
+sys.path.insert(0, '../')
+
+import json
+import time
+import errno
+import select
+import socket
+import struct
+import argparse
+import platform
+import multiprocessing
+from array import array
+
+from netkit.box import Box
+
+import melon
+from melon.utils import peek_box_header
+
+
+class RequestTemplate(object):
+    """
+    预先打包好请求，每次只替换sn
+    """
+
+    def __init__(self, box_class, cmd, body):
+        box = box_class()
+        box.cmd = cmd
+        box.body = body
+        self.data = box.pack()
+
+        attrs = box.header_attrs.items()
+        names = [name for name, (fmt, default) in attrs]
+        self.sn_struct = struct.Struct(box.header_fmt[0] + attrs[names.index('sn')][1][0])
+        self.sn_offset = struct.calcsize(
+            box.header_fmt[0] + ''.join(fmt for name, (fmt, default) in attrs[:names.index('sn')])
+        )
+
+    def make(self, sn):
+        data = bytearray(self.data)
+        self.sn_struct.pack_into(data, self.sn_offset, sn)
+        return str(data)
+
+
+class ClientConnection(object):
+
+    def __init__(self, sock, templates, depth):
+        self.sock = sock
+        self.templates = templates
+        self.depth = depth
+        self.read_buffer = ''
+        self.write_buffer = ''
+        # {sn: 发送时间}
+        self.pending = dict()
+        self._next_sn = 0
+
+    def fill(self, now):
+        """
+        补足在途的请求
+        """
+        while len(self.pending) < self.depth:
+            self._next_sn = (self._next_sn + 1) & 0x7fffffff
+            template = self.templates[self._next_sn % len(self.templates)]
+            self.write_buffer += template.make(self._next_sn)
+            self.pending[self._next_sn] = now
+
+    def flush(self):
+        """
+        :return: 是否还有没有发完的数据
+        """
+        while self.write_buffer:
+            try:
+                sent = self.sock.send(self.write_buffer)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return True
+                raise
+            self.write_buffer = self.write_buffer[sent:]
+
+        return False
+
+
+def run_process(host, port, connections, depth, cmds, body_len, duration, warmup, box_class, result_queue):
+    """
+    单个压测进程
+    """
+    body = 'x' * body_len
+    templates = [RequestTemplate(box_class, cmd, body) for cmd in cmds]
+
+    poller = select.poll()
+    conn_dict = dict()
+    for it in xrange(connections):
+        sock = socket.create_connection((host, port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        conn = ClientConnection(sock, templates, depth)
+        conn_dict[sock.fileno()] = conn
+        poller.register(sock.fileno(), select.POLLIN | select.POLLOUT)
+
+    latencies = array('d')
+    errors = 0
+    box = box_class()
+    sn_index = list(box.header_attrs.keys()).index('sn')
+    ret_index = list(box.header_attrs.keys()).index('ret')
+
+    begin_time = time.time()
+    measure_begin = begin_time + warmup
+    end_time = measure_begin + duration
+
+    for conn in conn_dict.values():
+        conn.fill(begin_time)
+
+    now = begin_time
+    while now < end_time:
+        for fd, event in poller.poll(100):
+            conn = conn_dict[fd]
+            now = time.time()
+
+            if event & (select.POLLERR | select.POLLHUP):
+                raise Exception('connection closed by server')
+
+            if event & select.POLLIN:
+                data = conn.sock.recv(65536)
+                if not data:
+                    raise Exception('connection closed by server')
+                conn.read_buffer += data
+
+                offset = 0
+                while True:
+                    ret, header = peek_box_header(box, buffer(conn.read_buffer, offset))
+                    if ret < 0:
+                        raise Exception('invalid response')
+                    if ret == 0:
+                        break
+                    offset += ret
+
+                    send_time = conn.pending.pop(header[sn_index], None)
+                    if send_time is not None and send_time >= measure_begin:
+                        latencies.append(now - send_time)
+                        if header[ret_index] != 0:
+                            errors += 1
+
+                conn.read_buffer = conn.read_buffer[offset:]
+                conn.fill(now)
+
+            if conn.flush():
+                poller.modify(fd, select.POLLIN | select.POLLOUT)
+            else:
+                poller.modify(fd, select.POLLIN)
+
+        now = time.time()
+
+    for conn in conn_dict.values():
+        conn.sock.close()
+
+    result_queue.put(dict(
+        latencies=latencies.tostring(),
+        errors=errors,
+        duration=min(now, end_time) - measure_begin,
+    ))
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(int(len(sorted_values) * p), len(sorted_values) - 1)]
+
+
+def run_load(host, port, connections=16, depth=8, cmds=(1,), body_len=32, duration=10, warmup=1,
+             procs=1, box_class=Box):
+    """
+    :param connections: 每个进程的连接数
+    :param depth: 每个连接在途的请求数，1即为closed-loop
+    :param cmds: 轮流发送的cmd
+    :param procs: 压测进程数
+    :return: 结果dict
+    """
+    result_queue = multiprocessing.Queue()
+    p_list = []
+    for it in xrange(procs):
+        p = multiprocessing.Process(target=run_process, args=(
+            host, port, connections, depth, cmds, body_len, duration, warmup, box_class, result_queue
+        ))
+        p.daemon = True
+        p.start()
+        p_list.append(p)
+
+    latencies = array('d')
+    errors = 0
+    durations = []
+    for it in xrange(procs):
+        result = result_queue.get(timeout=duration + warmup + 30)
+        latencies.fromstring(result['latencies'])
+        errors += result['errors']
+        durations.append(result['duration'])
+
+    for p in p_list:
+        p.join()
+
+    sorted_latencies = sorted(latencies)
+    measure_duration = max(durations)
+    to_ms = lambda value: round(value * 1000, 3)
+
+    return dict(
+        requests=len(sorted_latencies),
+        errors=errors,
+        duration=round(measure_duration, 3),
+        throughput=round(len(sorted_latencies) / measure_duration, 1) if measure_duration > 0 else 0,
+        latency_ms=dict(
+            mean=to_ms(sum(sorted_latencies) / len(sorted_latencies)) if sorted_latencies else 0,
+            p50=to_ms(percentile(sorted_latencies, 0.5)),
+            p99=to_ms(percentile(sorted_latencies, 0.99)),
+            p999=to_ms(percentile(sorted_latencies, 0.999)),
+            max=to_ms(sorted_latencies[-1]) if sorted_latencies else 0,
+        ),
+        params=dict(
+            connections=connections * procs,
+            depth=depth,
+            cmds=list(cmds),
+            body_len=body_len,
+            procs=procs,
+        ),
+        env=dict(
+            melon_version=melon.__version__,
+            python=platform.python_version(),
+            cpu_count=multiprocessing.cpu_count(),
+        ),
+    )
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='melon load generator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7777)
+    parser.add_argument('--mode', choices=('pipeline', 'closed'), default='pipeline')
+    parser.add_argument('--connections', type=int, default=16, help='connections per process')
+    parser.add_argument('--depth', type=int, default=8, help='in-flight requests per connection (pipeline mode)')
+    parser.add_argument('--cmds', default='1', help='comma separated cmds, sent in turn')
+    parser.add_argument('--body-len', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=1)
+    parser.add_argument('--procs', type=int, default=1)
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+
+    result = run_load(
+        args.host, args.port,
+        connections=args.connections,
+        depth=1 if args.mode == 'closed' else args.depth,
+        cmds=[int(cmd) for cmd in args.cmds.split(',')],
+        body_len=args.body_len,
+        duration=args.duration,
+        warmup=args.warmup,
+        procs=args.procs,
+    )
+    result['mode'] = args.mode
+
+    print json.dumps(result, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Connection.dataReceived 的拆包性能测试
+一个TCP包里面带有不同数量的box时，对比旧的字符串拼接方式与当前的offset方式的吞吐
+
+python read_buffer.py [body_len] [total_boxes]
+"""
+
+import sys
+sys.path.insert(0, '../')
+
+import time
+import itertools
+from netkit.box import Box
+
+from melon.connection import Connection
+
+
+class FakeApp(object):
+    box_class = Box
+    peek_box_header = False
+
+    def __init__(self):
+        self.conn_dict = dict()
+        self._conn_id_counter = itertools.count(1)
+
+    def alloc_conn_id(self):
+        return next(self._conn_id_counter)
+
+
+class FakeFactory(object):
+
+    def __init__(self):
+        self.app = FakeApp()
+
+
+class BenchConnection(Connection):
+    box_count = 0
+
+    def _on_read_complete(self, data, box, header=None):
+        self.box_count += 1
+
+
+class LegacyConnection(BenchConnection):
+    """
+    旧的实现: 每个box都会重新拷贝剩余的buffer
+    """
+
+    def __init__(self, factory, address):
+        BenchConnection.__init__(self, factory, address)
+        self._read_buffer = ''
+
+    def dataReceived(self, data):
+        self._read_buffer += data
+
+        while self._read_buffer:
+            box = self.factory.app.box_class()
+            ret = box.unpack(self._read_buffer)
+            if ret == 0:
+                return
+            elif ret > 0:
+                box_data = self._read_buffer[:ret]
+                self._read_buffer = self._read_buffer[ret:]
+                self._on_read_complete(box_data, box)
+            else:
+                self._read_buffer = ''
+                return
+
+
+def make_segment(boxes_per_segment, body_len):
+    box = Box()
+    box.cmd = 1
+    box.body = 'x' * body_len
+
+    return box.pack() * boxes_per_segment
+
+
+def run(conn_class, segment, boxes_per_segment, total_boxes):
+    conn = conn_class(FakeFactory(), ('127.0.0.1', 0))
+    segment_count = max(total_boxes / boxes_per_segment, 1)
+
+    begin = time.time()
+    for it in xrange(segment_count):
+        conn.dataReceived(segment)
+    cost = time.time() - begin
+
+    assert conn.box_count == segment_count * boxes_per_segment
+
+    return conn.box_count / cost if cost > 0 else 0
+
+
+def main():
+    body_len = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    total_boxes = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+
+    print '%-20s %-20s %-20s' % ('boxes_per_segment', 'legacy(box/s)', 'offset(box/s)')
+
+    for boxes_per_segment in (1, 10, 100, 1000, 5000):
+        segment = make_segment(boxes_per_segment, body_len)
+
+        legacy = run(LegacyConnection, segment, boxes_per_segment, total_boxes)
+        offset = run(BenchConnection, segment, boxes_per_segment, total_boxes)
+
+        print '%-20s %-20d %-20d' % (boxes_per_segment, legacy, offset)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+依次运行压测场景，每个场景单独启动服务端进程，结果每行一个json
+
+python run_suite.py [scenario ...] [--duration 10] [--output results.jsonl]
+"""
+
+import sys
+sys.path.insert(0, '../')
+
+import os
+import json
+import time
+import signal
+import socket
+import argparse
+import subprocess
+
+from scenarios import SCENARIOS
+from loadgen import run_load
+
+
+def get_skip_reason(name):
+    """
+    :return: 当前环境不能运行时返回原因，否则返回None
+    """
+    if SCENARIOS[name]['server'].get('frontend') == 'asyncio':
+        try:
+            import asyncio
+        except ImportError:
+            try:
+                import trollius
+            except ImportError:
+                return 'asyncio frontend needs trollius on python2, pip install trollius'
+
+    return None
+
+
+def wait_port(port, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return True
+        except socket.error:
+            time.sleep(0.1)
+
+    return False
+
+
+def run_scenario(name, port, duration, warmup, procs):
+    # 单独的进程组，结束时连同worker一起kill
+    server = subprocess.Popen([sys.executable, 'bench_server.py', name, str(port)], preexec_fn=os.setsid)
+
+    try:
+        if not wait_port(port, 10):
+            raise Exception('server not ready. scenario: %s' % name)
+
+        load = dict(SCENARIOS[name]['load'])
+        load.setdefault('cmds', sorted(SCENARIOS[name]['server']['groups'].keys()))
+        result = run_load('127.0.0.1', port, duration=duration, warmup=warmup, procs=procs, **load)
+    finally:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait()
+
+    result['scenario'] = name
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='run melon benchmark scenarios')
+    parser.add_argument('scenarios', nargs='*', help='default: all, available: %s' % ', '.join(SCENARIOS))
+    parser.add_argument('--port', type=int, default=7900)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=1)
+    parser.add_argument('--procs', type=int, default=1, help='load generator processes')
+    parser.add_argument('--output', help='append results to this file')
+    args = parser.parse_args()
+
+    output = open(args.output, 'a') if args.output else None
+
+    for name in args.scenarios or SCENARIOS.keys():
+        reason = get_skip_reason(name)
+        if reason:
+            print >> sys.stderr, 'skip scenario %s: %s' % (name, reason)
+            continue
+
+        result = run_scenario(name, args.port, args.duration, args.warmup, args.procs)
+        line = json.dumps(result, sort_keys=True)
+        print line
+        sys.stdout.flush()
+
+        if output:
+            output.write(line + '\n')
+            output.flush()
+
+    if output:
+        output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+压测场景
+
+server: 服务端配置
+    groups:     {group_id: group_conf}，每个group注册一个 cmd=group_id 的echo路由
+    app_attrs:  覆盖 Melon 的配置项
+    frontend:   twisted 或 asyncio
+load: 传给 loadgen.run_load 的参数，cmds 默认为所有的group_id
+"""
+
+import sys
+sys.path.insert(0, '../')
+
+from collections import OrderedDict
+
+from melon import ShmQueue
+
+
+SCENARIOS = OrderedDict([
+    ('baseline', dict(
+        server=dict(groups={1: dict(count=4)}),
+        load=dict(connections=16, depth=8, body_len=32),
+    )),
+    ('closed_loop', dict(
+        server=dict(groups={1: dict(count=4)}),
+        load=dict(connections=64, depth=1, body_len=32),
+    )),
+    ('single_worker', dict(
+        server=dict(groups={1: dict(count=1)}),
+        load=dict(connections=16, depth=8, body_len=32),
+    )),
+    ('many_workers', dict(
+        server=dict(groups={1: dict(count=16)}),
+        load=dict(connections=32, depth=8, body_len=32),
+    )),
+    ('many_groups', dict(
+        server=dict(groups=dict((group_id, dict(count=2)) for group_id in xrange(1, 5))),
+        load=dict(connections=16, depth=8, body_len=32),
+    )),
+    ('payload_1k', dict(
+        server=dict(groups={1: dict(count=4)}),
+        load=dict(connections=16, depth=8, body_len=1024),
+    )),
+    ('payload_64k', dict(
+        server=dict(groups={1: dict(count=4)}),
+        load=dict(connections=8, depth=4, body_len=64 * 1024),
+    )),
+    ('batch', dict(
+        server=dict(groups={1: dict(count=4, batch_max_msgs=64)}),
+        load=dict(connections=16, depth=8, body_len=32),
+    )),
+    ('compact_shm', dict(
+        server=dict(
+            groups={1: dict(count=4)},
+            app_attrs=dict(
+                compact_msg=True,
+                peek_box_header=True,
+                queue_class=ShmQueue,
+                read_worker_result_in_reactor=True,
+            ),
+        ),
+        load=dict(connections=16, depth=8, body_len=32),
+    )),
+    ('round_robin', dict(
+        server=dict(groups={1: dict(count=4, dispatch='round_robin')}),
+        load=dict(connections=16, depth=8, body_len=32),
+    )),
+    ('asyncio', dict(
+        server=dict(groups={1: dict(count=4)}, frontend='asyncio'),
+        load=dict(connections=16, depth=8, body_len=32),
+    )),
+])
@@ -4,5 +4,6 @@ __version__ = '1.0.86'
 
 from .melon import Melon
 from .blueprint import Blueprint
+from .shm_queue import ShmQueue
 from .log import logger
 from .utils import safe_call, safe_func
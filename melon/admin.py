@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+master的管理端口
+
+每个连接处理一个请求，返回之后关闭连接，支持两种格式:
+    HTTP:   GET /metrics HTTP/1.1，prometheus可以直接抓取
+    文本:   metrics\\n，可以直接用 nc 查看
+
+命令由 app.admin_commands 提供: {name: func(args)}，func返回str
+"""
+
+from twisted.internet.protocol import Protocol, Factory
+
+from .log import logger
+
+
+class AdminSession(object):
+    """
+    和网络层无关的请求解析
+    """
+
+    # 请求的最大长度，超过之后直接返回错误
+    max_request_size = 8192
+
+    def __init__(self, app):
+        self.app = app
+        self._buffer = ''
+
+    def feed(self, data):
+        """
+        :param data: 收到的数据
+        :return: 需要返回的数据，请求还不完整时返回None
+        """
+        self._buffer += data
+
+        pos = self._buffer.find('\n')
+        if pos < 0:
+            if len(self._buffer) > self.max_request_size:
+                return 'request too large\n'
+            return None
+
+        parts = self._buffer[:pos].split()
+        if len(parts) == 3 and parts[2].startswith('HTTP/'):
+            # 等到header全部收完再返回，避免关闭连接时还有没读的数据
+            if '\r\n\r\n' not in self._buffer and '\n\n' not in self._buffer:
+                if len(self._buffer) > self.max_request_size:
+                    return self._make_http_response('413 Request Entity Too Large', '')
+                return None
+
+            path_parts = parts[1].split('?', 1)
+            name = path_parts[0].strip('/')
+            args = path_parts[1].split('&') if len(path_parts) > 1 else []
+
+            ok, content = self.handle_command(name, args)
+            return self._make_http_response('200 OK' if ok else '404 Not Found', content)
+
+        if not parts:
+            return 'empty command\n'
+
+        ok, content = self.handle_command(parts[0], parts[1:])
+        return content
+
+    def handle_command(self, name, args):
+        """
+        :return: (是否成功, 返回的内容)
+        """
+        func = self.app.admin_commands.get(name or 'metrics')
+        if func is None:
+            return False, 'unknown command: %s\n' % name
+
+        try:
+            return True, func(args)
+        except Exception, e:
+            logger.error('admin command fail. name: %s, args: %r', name, args, exc_info=True)
+            return False, 'error: %s\n' % e
+
+    def _make_http_response(self, status, content):
+        return '\r\n'.join([
+            'HTTP/1.0 %s' % status,
+            'Content-Type: text/plain; version=0.0.4',
+            'Content-Length: %s' % len(content),
+            'Connection: close',
+            '',
+            content,
+        ])
+
+
+class AdminConnection(Protocol):
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.session = AdminSession(self.factory.app)
+
+    def dataReceived(self, data):
+        response = self.session.feed(data)
+        if response is not None:
+            self.transport.write(response)
+            self.transport.loseConnection()
+
+
+class AdminFactory(Factory):
+
+    def __init__(self, app):
+        self.app = app
+
+    def buildProtocol(self, addr):
+        return AdminConnection(self)
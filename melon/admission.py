@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+master中的连接准入和限速，在请求发给worker之前执行
+
+连接数:   全局和每个IP的连接数上限，超过时直接断开新连接
+限速:     每个连接、每个IP的令牌桶，分别限制每秒的帧数和字节数
+          超过时按 rate_limit_policy 处理: pause 暂停读取这个连接直到令牌足够; reject 返回 RET_RATE_LIMITED
+
+多acceptor时，每个acceptor进程单独统计
+"""
+
+import time
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst):
+        """
+        :param rate: 每秒补充的令牌数
+        :param burst: 桶的容量
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.update_time = time.time()
+
+    def refill(self, now):
+        self.tokens = min(self.tokens + (now - self.update_time) * self.rate, self.burst)
+        self.update_time = now
+
+    def consume(self, count, now):
+        """
+        令牌不够时也消耗，可以为负数
+        :return: 令牌恢复为非负数需要等待的秒数
+        """
+        self.refill(now)
+        self.tokens -= count
+
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def is_full(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+
+class AdmissionControl(object):
+
+    # 清理已经没有连接的IP的令牌桶的间隔(秒)
+    sweep_interval = 10
+
+    def __init__(self, app):
+        self.app = app
+        # {ip: 连接数}
+        self.ip_conn_count_dict = dict()
+        self.conn_count = 0
+        # {ip: (帧数的令牌桶, 字节数的令牌桶)}，IP的连接全部断开并且桶已满时才删除，避免重连绕过限速
+        # 断开时桶还没满的，由 sweep 定期删除
+        self.ip_bucket_dict = dict()
+
+    def on_connection_made(self, conn):
+        """
+        :return: 是否允许这个连接
+        """
+        app = self.app
+        ip = conn.address[0] if conn.address else None
+
+        if 0 < app.max_connections <= self.conn_count:
+            app.metrics.incr('melon_admission_rejected_total', (('reason', 'connections'),))
+            return False
+
+        ip_conn_count = self.ip_conn_count_dict.get(ip, 0)
+        if 0 < app.max_connections_per_ip <= ip_conn_count:
+            app.metrics.incr('melon_admission_rejected_total', (('reason', 'ip_connections'),))
+            return False
+
+        self.conn_count += 1
+        self.ip_conn_count_dict[ip] = ip_conn_count + 1
+
+        conn.rate_buckets = self._create_buckets(app.conn_rate_limit_frames, app.conn_rate_limit_bytes)
+        if ip not in self.ip_bucket_dict:
+            ip_buckets = self._create_buckets(app.ip_rate_limit_frames, app.ip_rate_limit_bytes)
+            if ip_buckets:
+                self.ip_bucket_dict[ip] = ip_buckets
+
+        return True
+
+    def on_connection_lost(self, conn):
+        ip = conn.address[0] if conn.address else None
+
+        self.conn_count -= 1
+        ip_conn_count = self.ip_conn_count_dict.pop(ip, 0) - 1
+        if ip_conn_count > 0:
+            self.ip_conn_count_dict[ip] = ip_conn_count
+            return
+
+        self._drop_idle_ip(ip, time.time())
+
+    def sweep(self):
+        """
+        删除已经没有连接，并且令牌桶已满的IP
+        """
+        now = time.time()
+        for ip in self.ip_bucket_dict.keys():
+            if ip not in self.ip_conn_count_dict:
+                self._drop_idle_ip(ip, now)
+
+    def _drop_idle_ip(self, ip, now):
+        if all(bucket is None or bucket.is_full(now) for bucket in self.ip_bucket_dict.get(ip) or ()):
+            self.ip_bucket_dict.pop(ip, None)
+
+    def check_frame(self, conn, size):
+        """
+        收到一帧数据时调用
+        :param size: 这一帧的字节数
+        :return: (是否允许, 需要暂停读取的秒数)
+        """
+        ip = conn.address[0] if conn.address else None
+        bucket_pairs = [(conn.rate_buckets, 'conn'), (self.ip_bucket_dict.get(ip), 'ip')]
+        now = time.time()
+
+        if self.app.rate_limit_policy == 'reject':
+            # 所有的桶都够了才消耗，避免被拒绝的帧也占用令牌
+            for buckets, scope in bucket_pairs:
+                if not self._has_tokens(buckets, size, now):
+                    self.app.metrics.incr('melon_rate_limited_total', (('scope', scope), ('policy', 'reject')))
+                    return False, 0
+
+            for buckets, scope in bucket_pairs:
+                self._consume(buckets, size, now)
+            return True, 0
+
+        delay = 0
+        for buckets, scope in bucket_pairs:
+            bucket_delay = self._consume(buckets, size, now)
+            if bucket_delay > 0:
+                self.app.metrics.incr('melon_rate_limited_total', (('scope', scope), ('policy', 'pause')))
+                delay = max(delay, bucket_delay)
+
+        return True, delay
+
+    def _create_buckets(self, frames_rate, bytes_rate):
+        if frames_rate <= 0 and bytes_rate <= 0:
+            return None
+
+        burst_seconds = self.app.rate_limit_burst_seconds
+        return (
+            TokenBucket(frames_rate, max(frames_rate * burst_seconds, 1)) if frames_rate > 0 else None,
+            TokenBucket(bytes_rate, max(bytes_rate * burst_seconds, 1)) if bytes_rate > 0 else None,
+        )
+
+    def _has_tokens(self, buckets, size, now):
+        if not buckets:
+            return True
+
+        frames_bucket, bytes_bucket = buckets
+        for bucket, count in ((frames_bucket, 1), (bytes_bucket, size)):
+            if bucket is None:
+                continue
+
+            bucket.refill(now)
+            # 比桶还大的帧，桶满时允许通过
+            if bucket.tokens < min(count, bucket.burst):
+                return False
+
+        return True
+
+    def _consume(self, buckets, size, now):
+        """
+        :return: 需要等待的秒数
+        """
+        if not buckets:
+            return 0
+
+        frames_bucket, bytes_bucket = buckets
+        delay = 0
+        for bucket, count in ((frames_bucket, 1), (bytes_bucket, size)):
+            if bucket is not None:
+                delay = max(delay, bucket.consume(count, now))
+
+        return delay
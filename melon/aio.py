@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+基于asyncio的master网络层，python2 下使用 trollius
+安装了 uvloop 时默认使用 uvloop
+"""
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from .connection import Connection
+from .admin import AdminSession
+from .utils import create_reuse_port_socket
+
+
+class TransportAdapter(object):
+    """
+    把asyncio的transport包装成twisted transport的接口，master中的其他代码不需要区分
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def writeSequence(self, data_list):
+        self.transport.writelines(data_list)
+
+    def loseConnection(self):
+        self.transport.close()
+
+    def abortConnection(self):
+        self.transport.abort()
+
+    def registerProducer(self, producer, streaming):
+        # asyncio 直接调用protocol的 pause_writing/resume_writing
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def get_write_buffer_size(self):
+        return self.transport.get_write_buffer_size()
+
+    @property
+    def bufferSize(self):
+        return self.transport.get_write_buffer_limits()[1]
+
+    @bufferSize.setter
+    def bufferSize(self, value):
+        self.transport.set_write_buffer_limits(high=value)
+
+    def pauseProducing(self):
+        self.transport.pause_reading()
+
+    def resumeProducing(self):
+        self.transport.resume_reading()
+
+    def getPeer(self):
+        return self.transport.get_extra_info('peername')
+
+
+class AioConnection(Connection, asyncio.Protocol):
+
+    def __init__(self, factory):
+        # 地址要在连接建立之后才能拿到
+        Connection.__init__(self, factory, None)
+
+    def connection_made(self, transport):
+        peername = transport.get_extra_info('peername')
+        self.address = tuple(peername[:2]) if peername else None
+        self.makeConnection(TransportAdapter(transport))
+
+    def data_received(self, data):
+        self.dataReceived(data)
+
+    def connection_lost(self, exc):
+        self.connected = 0
+        self.connectionLost(exc)
+
+    def pause_writing(self):
+        self.pauseProducing()
+
+    def resume_writing(self):
+        self.resumeProducing()
+
+
+class AioAdminConnection(asyncio.Protocol):
+
+    def __init__(self, app):
+        self.session = AdminSession(app)
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        response = self.session.feed(data)
+        if response is not None:
+            self.transport.write(response)
+            self.transport.close()
+
+
+class _LoopingCall(object):
+
+    def __init__(self, loop, interval, func, args, kwargs):
+        self.loop = loop
+        self.interval = interval
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self._handle = self.loop.call_later(self.interval, self._run)
+
+    def _run(self):
+        self._handle = self.loop.call_later(self.interval, self._run)
+        self.func(*self.args, **self.kwargs)
+
+    def stop(self):
+        self._handle.cancel()
+
+
+class AsyncioFrontend(object):
+    """
+    asyncio event loop
+    """
+
+    name = 'asyncio'
+
+    # 安装了uvloop时是否使用
+    use_uvloop = True
+
+    connection_class = AioConnection
+
+    def __init__(self, app):
+        self.app = app
+
+        if self.use_uvloop:
+            try:
+                import uvloop
+                asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            except ImportError:
+                pass
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    @classmethod
+    def reinstall(cls):
+        """
+        每次都会创建新的loop，不需要处理
+        """
+
+    def listen(self, host, port, backlog, reuse_port=False):
+        factory = self.app.connection_factory_class(self.app)
+
+        if reuse_port:
+            server = self.loop.create_server(
+                lambda: self.connection_class(factory), sock=create_reuse_port_socket(host, port, backlog)
+            )
+        else:
+            server = self.loop.create_server(
+                lambda: self.connection_class(factory), host, port, backlog=backlog
+            )
+
+        return self.loop.run_until_complete(server)
+
+    def listen_admin(self, host, port):
+        return self.loop.run_until_complete(
+            self.loop.create_server(lambda: AioAdminConnection(self.app), host, port)
+        )
+
+    def run(self):
+        self.loop.run_forever()
+
+    def stop(self):
+        # 可能在信号处理函数中调用
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def call_later(self, delay, func, *args, **kwargs):
+        if kwargs:
+            return self.loop.call_later(delay, lambda: func(*args, **kwargs))
+        return self.loop.call_later(delay, func, *args)
+
+    def cancel_call(self, handle):
+        handle.cancel()
+
+    def call_from_thread(self, func, *args, **kwargs):
+        if kwargs:
+            self.loop.call_soon_threadsafe(lambda: func(*args, **kwargs))
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def looping_call(self, interval, func, *args, **kwargs):
+        return _LoopingCall(self.loop, interval, func, args, kwargs)
+
+    def add_reader(self, reader):
+        self.loop.add_reader(reader.fileno(), reader.doRead)
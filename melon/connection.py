@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import time
 from twisted.internet.protocol import Protocol, Factory
 
-from .utils import safe_call
+from .utils import safe_call, peek_box_header
 from .log import logger
+from . import constants
+
+
+# 发送缓冲区满导致的暂停读取
+WRITE_FULL = 'write_full'
+# 超过限速导致的暂停读取
+RATE_LIMITED = 'rate_limited'
 
 
 class ConnectionFactory(Factory):
@@ -16,14 +24,148 @@ class ConnectionFactory(Factory):
 
 
 class Connection(Protocol):
+    # 已消费的数据超过这个长度时，才真正把前面的数据从buffer里删掉
+    read_buffer_compact_size = 64 * 1024
+
     _read_buffer = None
+    # 当前已经解析到的位置
+    _read_offset = 0
+    # 暂停读取的原因: group过载时为对应的group_id，发送缓冲区满时为 WRITE_FULL，超过限速时为 RATE_LIMITED
+    _pausing_group_ids = None
+    # 超过限速暂停读取时，buffer中已经收到的数据也不再解析
+    _rate_paused = False
+    # 是否通过了连接准入
+    _admitted = False
+    # 没有通过连接准入，等待断开，收到的数据直接丢弃
+    _rejected = False
+    # 连接的令牌桶 (帧数, 字节数)，由 AdmissionControl 创建
+    rate_buckets = None
+    # 是否注册为transport的producer
+    _producer_registered = False
+    # 合并发送的数据
+    _write_pending = None
+    _write_pending_size = 0
+
+    conn_id = None
 
     def __init__(self, factory, address):
         self.factory = factory
         self.address = address
-        self._read_buffer = ''
-        # 放到弱引用映射里去
-        self.factory.app.conn_dict[id(self)] = self
+        self._read_buffer = bytearray()
+        self._read_offset = 0
+        self._write_pending = []
+        self._write_pending_size = 0
+        # conn_id 不会重复使用，worker返回给已经断开的连接时直接丢弃
+        self.conn_id = self.factory.app.alloc_conn_id()
+        self.factory.app.conn_dict[self.conn_id] = self
+
+    def connectionMade(self):
+        admission = self.factory.app.admission
+        if admission:
+            if not admission.on_connection_made(self):
+                logger.error('connection rejected. address: %s', self.address)
+                self._rejected = True
+                # asyncio 在 connection_made 中还没有注册好transport，不能直接断开
+                self.factory.app.frontend.call_later(0, self.transport.abortConnection)
+                return
+            self._admitted = True
+
+        pause_size = self.factory.app.conn_write_pause_size
+        if pause_size > 0:
+            # 发送缓冲区超过 bufferSize 时，transport会调用 pauseProducing，发送完之后调用 resumeProducing
+            self.transport.bufferSize = pause_size
+            self.transport.registerProducer(self, True)
+            self._producer_registered = True
+
+    def connectionLost(self, reason):
+        self.factory.app.conn_dict.pop(self.conn_id, None)
+        if self._admitted:
+            self._admitted = False
+            self.factory.app.admission.on_connection_lost(self)
+        self.unregister_producer()
+        self._write_pending = []
+        self._write_pending_size = 0
+
+    def unregister_producer(self):
+        """
+        关闭连接之前调用，注册了producer时，twisted的 loseConnection 会一直等待producer，连接永远不会关闭
+        """
+        if self._producer_registered:
+            self._producer_registered = False
+            self.transport.unregisterProducer()
+
+    def pauseProducing(self):
+        """
+        发送缓冲区满了，客户端读取太慢，先不读取新的请求
+        """
+        if self.factory.app.conn_write_pause_size <= 0:
+            return
+
+        self.factory.app.metrics.incr('melon_conn_write_paused_total')
+        self.pause_reading(WRITE_FULL)
+
+    def resumeProducing(self):
+        self.resume_reading(WRITE_FULL)
+
+    def stopProducing(self):
+        pass
+
+    def queue_write(self, data):
+        """
+        合并发送，由app在这一批返回处理完之后调用 flush_writes
+        :return: 是否需要app之后调用 flush_writes
+        """
+        self._write_pending.append(data)
+        self._write_pending_size += len(data)
+
+        if self._write_pending_size >= self.factory.app.write_coalesce_max_bytes:
+            self.flush_writes()
+            return False
+
+        return len(self._write_pending) == 1
+
+    def flush_writes(self):
+        """
+        发送合并的数据，发送缓冲区超过 conn_write_buffer_max_size 时断开连接
+        """
+        if not self._write_pending:
+            return
+
+        data_list = self._write_pending
+        self._write_pending = []
+        self._write_pending_size = 0
+
+        if not self.transport or not self.connected:
+            return
+
+        if len(data_list) == 1:
+            self.transport.write(data_list[0])
+        else:
+            self.transport.writeSequence(data_list)
+
+        max_size = self.factory.app.conn_write_buffer_max_size
+        if max_size > 0:
+            buffer_size = self.get_write_buffer_size()
+            if buffer_size > max_size:
+                logger.error('write buffer overflow, abort connection. address: %s, buffer_size: %s',
+                             self.address, buffer_size)
+                self.factory.app.metrics.incr('melon_conn_write_overflow_total')
+                self.transport.abortConnection()
+                # 之后的返回直接丢弃
+                self.connected = 0
+
+    def get_write_buffer_size(self):
+        """
+        transport中还没有发送出去的字节数
+        """
+        if hasattr(self.transport, 'get_write_buffer_size'):
+            return self.transport.get_write_buffer_size()
+
+        # twisted 的 FileDescriptor 没有公开的接口，只能读取内部属性
+        # 其他transport(例如TLS)或者twisted版本没有这些属性时，当作已经全部发出
+        transport = self.transport
+        return max(len(getattr(transport, 'dataBuffer', '')) - getattr(transport, 'offset', 0) +
+                   getattr(transport, '_tempDataLen', 0), 0)
 
     def dataReceived(self, data):
         """
@@ -31,44 +173,158 @@ class Connection(Protocol):
         :param data:
         :return:
         """
-        self._read_buffer += data
+        if self._rejected:
+            return
 
-        while self._read_buffer:
+        self._read_buffer.extend(data)
+        self._process_read_buffer()
+
+    def _process_read_buffer(self):
+        """
+        解析buffer中已经收到的数据
+        """
+        while self._read_offset < len(self._read_buffer) and not self._rate_paused:
             # 因为box后面还是要用的
             box = self.factory.app.box_class()
-            ret = box.unpack(self._read_buffer)
+            # buffer 不会拷贝数据，切片时才会生成对应长度的str
+            view = buffer(self._read_buffer, self._read_offset)
+            if self.factory.app.peek_box_header:
+                # 只解析包头，包体交给worker
+                ret, header = peek_box_header(box, view)
+            else:
+                ret, header = box.unpack(view), None
             if ret == 0:
                 # 说明要继续收
-                return
+                break
             elif ret > 0:
                 # 收好了
-                box_data = self._read_buffer[:ret]
-                self._read_buffer = self._read_buffer[ret:]
-                safe_call(self._on_read_complete, box_data, box)
+                box_data = view[:ret]
+                self._read_offset += ret
+                safe_call(self._on_read_complete, box_data, box, header)
                 continue
             else:
                 # 数据已经混乱了，全部丢弃
-                logger.error('buffer invalid. ret: %d, read_buffer: %r', ret, self._read_buffer)
-                self._read_buffer = ''
+                logger.error('buffer invalid. ret: %d, read_buffer: %r',
+                             ret, str(self._read_buffer[self._read_offset:]))
+                self.factory.app.metrics.incr('melon_invalid_data_total')
+                self._read_buffer = bytearray()
+                self._read_offset = 0
                 return
 
-    def _on_read_complete(self, data, box):
+        self._compact_read_buffer()
+
+    def _compact_read_buffer(self):
+        """
+        把已经消费的数据从buffer中删掉
+        全部消费完的时候直接清空，否则只有积累到一定长度才移动数据，避免每个box都拷贝一次
+        :return:
+        """
+        if not self._read_offset:
+            return
+
+        if self._read_offset >= len(self._read_buffer):
+            del self._read_buffer[:]
+            self._read_offset = 0
+        elif self._read_offset >= self.read_buffer_compact_size:
+            del self._read_buffer[:self._read_offset]
+            self._read_offset = 0
+
+    def _on_read_complete(self, data, box, header=None):
         """
         完整数据接收完成
         :param data: 原始数据
         :param box: 解析之后的box
+        :param header: peek_box_header 模式下解析出的包头，会随msg一起发给worker
         :return:
         """
+        admission = self.factory.app.admission
+        if admission:
+            allowed, delay = admission.check_frame(self, len(data))
+            if not allowed:
+                self.flush_writes()
+                self.transport.write(box.map(dict(ret=constants.RET_RATE_LIMITED)).pack())
+                return
+            if delay > 0:
+                # 这一帧仍然发给worker，之后的数据等令牌足够时再读取
+                self._pause_for_rate_limit(delay)
+
         msg = dict(
-            conn_id=id(self),
+            conn_id=self.conn_id,
             address=self.address,
             data=data,
+            # worker根据这个时间判断请求是否已经超过deadline
+            recv_time=time.time(),
         )
+        if header is not None:
+            msg['header'] = header
+
+        response_cache = self.factory.app.response_cache
+        if response_cache:
+            cache_key = self.factory.app.get_cache_key(box, data, header)
+            if cache_key is not None:
+                if self.factory.app.reply_from_cache(self, box, cache_key):
+                    return
+                # worker返回时带回来，master写入缓存
+                msg['cache'] = (cache_key, response_cache.epoch)
 
         # 获取映射的group_id
         group_id = self.factory.app.group_router(box)
+        priority = None
+        if isinstance(group_id, tuple):
+            if len(group_id) > 2:
+                # 同时返回了分发使用的key和优先级
+                group_id, key, priority = group_id
+            else:
+                # 同时返回了分发使用的key
+                group_id, key = group_id
+        else:
+            key = None
+
+        if priority is None:
+            priority = self.factory.app.get_priority(group_id, box)
+
+        if not self.factory.app.check_overload(group_id, self):
+            # group过载，直接拒绝，之前合并的返回要先发出去
+            self.flush_writes()
+            self.transport.write(box.map(dict(ret=constants.RET_OVERLOAD)).pack())
+            return
+
+        self.factory.app.put_to_group(group_id, msg, key, priority)
+
+    def _pause_for_rate_limit(self, delay):
+        if self._rate_paused:
+            return
+
+        self._rate_paused = True
+        self.pause_reading(RATE_LIMITED)
+        self.factory.app.frontend.call_later(delay, self._resume_for_rate_limit)
+
+    def _resume_for_rate_limit(self):
+        self._rate_paused = False
+        self.resume_reading(RATE_LIMITED)
+
+        if self.connected:
+            self._process_read_buffer()
+
+    def pause_reading(self, group_id):
+        """
+        group过载或者发送缓冲区满时暂停读取
+        :param group_id: 暂停的原因，发送缓冲区满时为 WRITE_FULL
+        """
+        if not self._pausing_group_ids:
+            self._pausing_group_ids = set()
+            if self.connected:
+                self.transport.pauseProducing()
+
+        self._pausing_group_ids.add(group_id)
+
+    def resume_reading(self, group_id):
+        """
+        所有导致暂停的group都恢复之后，才恢复读取
+        """
+        if not self._pausing_group_ids or group_id not in self._pausing_group_ids:
+            return
 
-        try:
-            self.factory.app.parent_output_dict[group_id].put_nowait(msg)
-        except:
-            logger.error('exc occur. msg: %r', msg, exc_info=True)
+        self._pausing_group_ids.discard(group_id)
+        if not self._pausing_group_ids and self.connected:
+            self.transport.resumeProducing()
@@ -5,8 +5,23 @@ NAME = 'melon'
 # 系统返回码
 RET_INVALID_CMD = -10000
 RET_INTERNAL = -10001
+# group过载，请求被拒绝
+RET_OVERLOAD = -10002
+# 请求在队列中等待超过deadline，没有处理
+RET_DEADLINE_EXCEEDED = -10003
+# 超过限速，请求被拒绝
+RET_RATE_LIMITED = -10004
+
+# conn_id 的组成: master的代号 | acceptor序号 | 递增序号
+# 递增序号占用的位数
+CONN_ID_SEQ_BITS = 40
+# acceptor序号占用的位数
+CONN_ID_ACCEPTOR_BITS = 8
 
 # 默认host和port
 SERVER_HOST = '127.0.0.1'
 SERVER_PORT = 7777
 SERVER_BACKLOG = 256
+
+# 管理端口默认只监听本机
+ADMIN_HOST = '127.0.0.1'
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+master把msg分发到group内worker的策略
+
+shared:             所有worker共用一个队列，由worker自己竞争(默认)
+round_robin:        每个worker一个队列，轮流分发
+least_loaded:       每个worker一个队列，发给未完成请求最少的worker(根据worker的返回统计)
+consistent_hash:    每个worker一个队列，按照conn_id或者group_router返回的key做一致性hash
+"""
+
+import bisect
+import zlib
+
+
+class SharedDispatcher(object):
+    """
+    所有worker共用一个队列
+    """
+
+    # worker的返回中是否需要带上负载信息
+    report_load = False
+
+    def __init__(self, worker_count, queue_factory):
+        """
+        :param worker_count: worker数量
+        :param queue_factory: 创建队列的函数
+        """
+        self.worker_count = worker_count
+        self.queues = self._create_queues(queue_factory)
+        self.alive_list = range(worker_count)
+
+    def _create_queues(self, queue_factory):
+        return [queue_factory()]
+
+    def get_worker_queue_index(self, worker_index):
+        """
+        worker读取的队列
+        """
+        return 0
+
+    def select(self, msg, key):
+        """
+        选择msg要发往的队列
+        :param msg:
+        :param key: group_router 返回的key，没有则为conn_id
+        :return: 队列的index
+        """
+        return 0
+
+    def on_dispatch(self, queue_index):
+        """
+        msg已经放入队列
+        """
+
+    def on_response(self, msg):
+        """
+        收到worker的返回
+        """
+
+    def set_worker_alive(self, worker_index, alive):
+        """
+        worker进程挂掉或者重新启动之后调用，用来重新分配
+        """
+        alive_set = set(self.alive_list)
+        if alive:
+            alive_set.add(worker_index)
+        else:
+            alive_set.discard(worker_index)
+
+        self.alive_list = sorted(alive_set)
+        self._on_alive_changed(worker_index, alive)
+
+    def _on_alive_changed(self, worker_index, alive):
+        pass
+
+    def qsize(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+
+class PerWorkerDispatcher(SharedDispatcher):
+    """
+    每个worker一个队列
+    """
+
+    def _create_queues(self, queue_factory):
+        return [queue_factory() for it in xrange(self.worker_count)]
+
+    def get_worker_queue_index(self, worker_index):
+        return worker_index
+
+    def _candidates(self):
+        # 全挂掉的时候，还是放到队列里等worker重启
+        return self.alive_list or range(self.worker_count)
+
+
+class RoundRobinDispatcher(PerWorkerDispatcher):
+
+    _cursor = 0
+
+    def select(self, msg, key):
+        candidates = self._candidates()
+        self._cursor = (self._cursor + 1) % len(candidates)
+        return candidates[self._cursor]
+
+
+class LeastLoadedDispatcher(PerWorkerDispatcher):
+    """
+    未完成请求数 = 发给worker的请求数 - worker已经处理完的请求数
+    worker已经处理完的请求数由worker在返回中带上，所以不产生返回的请求要等到下一次返回时才会被统计到
+    平滑重启时新旧worker读取同一个队列，各自从0开始计数，所以按generation分别记录，未完成请求数减去它们的和
+    """
+
+    report_load = True
+
+    def __init__(self, worker_count, queue_factory):
+        super(LeastLoadedDispatcher, self).__init__(worker_count, queue_factory)
+        self.dispatched_list = [0] * worker_count
+        # 每个worker_index一个dict: {generation: 处理完的请求数}
+        self.handled_list = [dict() for it in xrange(worker_count)]
+
+    def select(self, msg, key):
+        return min(self._candidates(), key=self.get_outstanding)
+
+    def get_outstanding(self, worker_index):
+        return max(self.dispatched_list[worker_index] - sum(self.handled_list[worker_index].itervalues()), 0)
+
+    def on_dispatch(self, queue_index):
+        self.dispatched_list[queue_index] += 1
+
+    def on_response(self, msg):
+        worker_index = msg.get('worker_index')
+        if worker_index is None:
+            return
+
+        handled_dict = self.handled_list[worker_index]
+        generation = msg.get('generation', 0)
+        if generation not in handled_dict:
+            self._fold_old_generations(worker_index)
+
+        handled_dict[generation] = max(handled_dict.get(generation, 0), msg.get('handled', 0))
+
+    def _fold_old_generations(self, worker_index):
+        """
+        出现新的generation时，只有上一个generation的worker可能还没有退出
+        更早的generation的计数不会再变化，从发出的请求数中减掉，避免dict一直增长
+        """
+        handled_dict = self.handled_list[worker_index]
+        for generation in sorted(handled_dict)[:-1]:
+            self.dispatched_list[worker_index] -= handled_dict.pop(generation)
+
+    def _on_alive_changed(self, worker_index, alive):
+        if alive:
+            # 新进程从0开始计数，队列里还没处理的msg都算作未完成
+            self.dispatched_list[worker_index] = self.queues[worker_index].qsize()
+            self.handled_list[worker_index].clear()
+
+
+class ConsistentHashDispatcher(PerWorkerDispatcher):
+    """
+    worker挂掉时，只有原来分到这个worker的key会被重新分配
+    """
+
+    # 每个worker在环上的虚拟节点数
+    virtual_nodes = 100
+
+    def __init__(self, worker_count, queue_factory):
+        super(ConsistentHashDispatcher, self).__init__(worker_count, queue_factory)
+        self._build_ring()
+
+    def select(self, msg, key):
+        pos = bisect.bisect(self._ring_keys, self._hash(key)) % len(self._ring_keys)
+        return self._ring_values[pos]
+
+    def _on_alive_changed(self, worker_index, alive):
+        self._build_ring()
+
+    def _build_ring(self):
+        ring = sorted(
+            (self._hash('%s-%s' % (worker_index, it)), worker_index)
+            for worker_index in self._candidates() for it in xrange(self.virtual_nodes)
+        )
+        self._ring_keys = [k for k, v in ring]
+        self._ring_values = [v for k, v in ring]
+
+    def _hash(self, key):
+        return zlib.crc32(str(key)) & 0xffffffff
+
+
+DISPATCHER_CLASSES = dict(
+    shared=SharedDispatcher,
+    round_robin=RoundRobinDispatcher,
+    least_loaded=LeastLoadedDispatcher,
+    consistent_hash=ConsistentHashDispatcher,
+)
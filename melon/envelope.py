@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+master与worker之间传输msg时使用的紧凑二进制格式，用来替代pickle整个dict
+
+格式: 固定长度的头部 + host + header + extras + data
+    flags:          B   标记哪些字段存在
+    conn_id:        Q
+    pid:            I
+    port:           H
+    host_len:       B
+    header_count:   B   peek_box_header 模式下包头字段的数量，每个字段为 q
+    extras_len:     I   其他字段pickle之后的长度
+    data_len:       I
+    recv_time:      d   master收到请求的时间
+
+pack/unpack 的输入输出都是与原来相同的dict，所以各种事件回调里看到的msg不变
+"""
+
+import struct
+import cPickle as pickle
+
+FLAG_DATA = 1 << 0
+FLAG_ADDRESS = 1 << 1
+FLAG_HEADER = 1 << 2
+FLAG_PID = 1 << 3
+FLAG_EXTRAS = 1 << 4
+FLAG_RECV_TIME = 1 << 5
+
+ENVELOPE_FMT = '!BQIHBBIId'
+ENVELOPE_LEN = struct.calcsize(ENVELOPE_FMT)
+
+_envelope_struct = struct.Struct(ENVELOPE_FMT)
+# {header_count: struct.Struct}
+_header_struct_dict = dict()
+
+# 头部直接支持的字段，其他字段都放到extras里
+ENVELOPE_KEYS = frozenset(['conn_id', 'address', 'data', 'header', 'pid', 'recv_time'])
+
+
+def pack(msg):
+    """
+    把msg打包为str
+    :param msg: dict
+    :return:
+    """
+    flags = 0
+
+    data = msg.get('data')
+    if data is not None:
+        flags |= FLAG_DATA
+    else:
+        data = ''
+
+    address = msg.get('address')
+    if address:
+        flags |= FLAG_ADDRESS
+        host, port = address
+    else:
+        host, port = '', 0
+
+    header = msg.get('header')
+    if header is not None:
+        flags |= FLAG_HEADER
+        header_data = _get_header_struct(len(header)).pack(*header)
+    else:
+        header = header_data = ''
+
+    pid = msg.get('pid')
+    if pid is not None:
+        flags |= FLAG_PID
+    else:
+        pid = 0
+
+    recv_time = msg.get('recv_time')
+    if recv_time is not None:
+        flags |= FLAG_RECV_TIME
+    else:
+        recv_time = 0
+
+    extra_keys = msg.viewkeys() - ENVELOPE_KEYS
+    if extra_keys:
+        flags |= FLAG_EXTRAS
+        extras_data = pickle.dumps(dict((k, msg[k]) for k in extra_keys), pickle.HIGHEST_PROTOCOL)
+    else:
+        extras_data = ''
+
+    return ''.join((
+        _envelope_struct.pack(flags, msg.get('conn_id') or 0, pid, port,
+                              len(host), len(header), len(extras_data), len(data), recv_time),
+        host, header_data, extras_data, data,
+    ))
+
+
+def unpack(buf):
+    """
+    把 pack 的结果还原为dict
+    :param buf: str
+    :return:
+    """
+    flags, conn_id, pid, port, host_len, header_count, extras_len, data_len, recv_time = \
+        _envelope_struct.unpack_from(buf)
+
+    msg = dict(conn_id=conn_id)
+
+    pos = ENVELOPE_LEN
+    if flags & FLAG_ADDRESS:
+        msg['address'] = (buf[pos:pos + host_len], port)
+    pos += host_len
+
+    if flags & FLAG_HEADER:
+        msg['header'] = _get_header_struct(header_count).unpack_from(buf, pos)
+    pos += header_count * 8
+
+    if flags & FLAG_EXTRAS:
+        msg.update(pickle.loads(buf[pos:pos + extras_len]))
+    pos += extras_len
+
+    msg['data'] = buf[pos:pos + data_len] if flags & FLAG_DATA else None
+
+    if flags & FLAG_PID:
+        msg['pid'] = pid
+
+    if flags & FLAG_RECV_TIME:
+        msg['recv_time'] = recv_time
+
+    return msg
+
+
+def _get_header_struct(header_count):
+    header_struct = _header_struct_dict.get(header_count)
+    if header_struct is None:
+        header_struct = _header_struct_dict[header_count] = struct.Struct('!%dq' % header_count)
+    return header_struct
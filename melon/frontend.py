@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+master的网络层
+
+master中需要用到事件循环的地方都通过frontend调用，这样同一个app可以选择运行在twisted或者asyncio上
+连接对象统一提供twisted风格的transport(write、writeSequence、loseConnection、pauseProducing、resumeProducing)
+"""
+
+import sys
+
+from .utils import create_reuse_port_socket
+
+
+class TwistedFrontend(object):
+    """
+    twisted reactor
+    """
+
+    name = 'twisted'
+
+    def __init__(self, app):
+        # 在这里才import，保证fork出来的进程可以安装自己的reactor
+        from twisted.internet import reactor
+        self.app = app
+        self.reactor = reactor
+
+    @classmethod
+    def reinstall(cls):
+        """
+        fork出来的进程如果继承了父进程已经创建的reactor，epoll等fd是共用的，需要重新安装一个
+        """
+        if 'twisted.internet.reactor' not in sys.modules:
+            return
+
+        del sys.modules['twisted.internet.reactor']
+        from twisted.internet import default
+        default.install()
+
+    def listen(self, host, port, backlog, reuse_port=False):
+        factory = self.app.connection_factory_class(self.app)
+
+        if not reuse_port:
+            return self.reactor.listenTCP(port, factory, backlog=backlog, interface=host)
+
+        sock = create_reuse_port_socket(host, port, backlog)
+        try:
+            return self.reactor.adoptStreamPort(sock.fileno(), sock.family, factory)
+        finally:
+            # adoptStreamPort 会dup一份fd
+            sock.close()
+
+    def listen_admin(self, host, port):
+        from .admin import AdminFactory
+        return self.reactor.listenTCP(port, AdminFactory(self.app), interface=host)
+
+    def run(self):
+        self.reactor.run(installSignalHandlers=False)
+
+    def stop(self):
+        self.reactor.stop()
+
+    def call_later(self, delay, func, *args, **kwargs):
+        return self.reactor.callLater(delay, func, *args, **kwargs)
+
+    def cancel_call(self, handle):
+        if handle.active():
+            handle.cancel()
+
+    def call_from_thread(self, func, *args, **kwargs):
+        # 参考 http://twistedsphinx.funsize.net/projects/core/howto/threading.html
+        self.reactor.callFromThread(func, *args, **kwargs)
+
+    def looping_call(self, interval, func, *args, **kwargs):
+        """
+        :return: 提供stop方法
+        """
+        from twisted.internet.task import LoopingCall
+        call = LoopingCall(func, *args, **kwargs)
+        call.start(interval, now=False)
+        return call
+
+    def add_reader(self, reader):
+        """
+        :param reader: 提供 fileno、doRead
+        """
+        self.reactor.addReader(reader)
+
+
+def get_frontend_class(name):
+    """
+    asyncio 的 frontend 只在使用时才import
+    """
+    if name == 'twisted':
+        return TwistedFrontend
+    elif name == 'asyncio':
+        from .aio import AsyncioFrontend
+        return AsyncioFrontend
+
+    raise ValueError('invalid frontend: %r' % name)
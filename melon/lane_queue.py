@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+按优先级分为多个lane的队列，给开启了 priorities 的group使用
+
+每个lane是一个普通的队列(multiprocessing.Queue 或 ShmQueue)，另外用一个信号量记录所有lane中msg的总数
+worker阻塞在信号量上，被唤醒之后按优先级从高到低读取，lane 0 的优先级最高
+为了避免低优先级的lane饿死，一个lane被跳过 starvation_limit 次之后，下一次优先读取它
+"""
+
+import time
+from Queue import Empty
+from multiprocessing import Semaphore
+
+
+class LaneQueue(object):
+
+    # multiprocessing.Queue 的put由feeder线程完成，信号量先于数据到达时，等待的间隔(秒)
+    retry_interval = 0.0001
+
+    def __init__(self, lane_count, queue_factory, starvation_limit=8):
+        """
+        :param lane_count: lane的数量
+        :param queue_factory: 创建每个lane的队列的函数
+        :param starvation_limit: 低优先级的lane最多被跳过的次数
+        """
+        self.queues = [queue_factory() for it in xrange(lane_count)]
+        self.starvation_limit = starvation_limit
+        self._sem = Semaphore(0)
+        # 每个lane被更高优先级的lane抢先读取的次数，每个进程单独统计
+        self._skipped_list = [0] * lane_count
+
+    def put_nowait(self, obj, lane=None):
+        """
+        :param lane: 不传则放入优先级最低的lane，控制消息需要排在已有的msg之后
+        """
+        if lane is None:
+            lane = len(self.queues) - 1
+
+        self.queues[lane].put_nowait(obj)
+        self._sem.release()
+
+    def get(self, block=True, timeout=None):
+        if not self._sem.acquire(block, timeout):
+            raise Empty
+
+        # 已经占到了一条msg，只是不确定在哪个lane
+        while 1:
+            for lane in self._get_lane_order():
+                try:
+                    obj = self.queues[lane].get_nowait()
+                except Empty:
+                    # 空的lane不算饿死
+                    self._skipped_list[lane] = 0
+                    continue
+
+                self._on_lane_read(lane)
+                return obj
+
+            time.sleep(self.retry_interval)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    def lane_qsize(self, lane):
+        return self.queues[lane].qsize()
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def _get_lane_order(self):
+        starving = [lane for lane, skipped in enumerate(self._skipped_list) if skipped >= self.starvation_limit]
+        if not starving:
+            return xrange(len(self.queues))
+
+        return starving + [lane for lane in xrange(len(self.queues)) if lane not in starving]
+
+    def _on_lane_read(self, lane):
+        self._skipped_list[lane] = 0
+        for lower_lane in xrange(lane + 1, len(self.queues)):
+            self._skipped_list[lower_lane] += 1
@@ -2,20 +2,36 @@
 
 import sys
 import time
-from multiprocessing import Queue, Process
-import weakref
+import functools
+from multiprocessing import Process, Lock
+from multiprocessing.queues import Queue
+from multiprocessing.sharedctypes import RawArray
+import os
+import itertools
 from threading import Thread
-# linux 默认就是epoll
-from twisted.internet import reactor
 import signal
+import select
+import errno
+import fcntl
 from collections import Counter
 import setproctitle
 
 from .log import logger
+from .utils import safe_call, get_group_counts, restore_box
 from .connection import ConnectionFactory
+from .frontend import get_frontend_class
 from .worker import Worker
+from .dispatcher import DISPATCHER_CLASSES
 from .mixins import RoutesMixin, AppEventsMixin
 from .request import Request
+from .queue_reader import QueueReader, drain_queue
+from .lane_queue import LaneQueue
+from .shm_arena import ShmArena, release_msgs
+from .admission import AdmissionControl
+from .response_cache import ResponseCache
+from .metrics import Metrics
+from .profiler import Profiler
+from . import envelope
 from . import constants
 
 
@@ -31,19 +47,160 @@ class Melon(RoutesMixin, AppEventsMixin):
 
     group_conf = None
     group_router = None
+
+    # master只解析包头(group_router只能使用包头字段)，包头随msg发给worker，worker不再重复解析
+    # 要求 box_class 和 netkit.box.Box 一样提供 header_attrs、header_fmt、header_len
+    peek_box_header = False
+
+    # master与worker之间的msg使用 envelope 打包为紧凑的二进制格式，而不是pickle整个dict
+    # 事件回调中看到的msg仍然是dict
+    compact_msg = False
+
+    # master的网络层: twisted 或 asyncio，run 时也可以指定
+    frontend_name = 'twisted'
+
+    # worker返回的队列直接注册到reactor上读取，不再使用轮询线程
+    read_worker_result_in_reactor = False
+    # 每次交给reactor处理的worker返回的最大数量
+    worker_result_max_batch = 1000
+
+    # worker的返回按连接合并，一批返回处理完之后每个连接只调用一次 writeSequence
+    # 单个连接合并的数据达到这个字节数时立即发送
+    write_coalesce_max_bytes = 64 * 1024
+    # 大于0时，合并的数据最多再等待的毫秒数，可以跨越多批返回，0代表每批返回处理完立即发送
+    write_coalesce_delay_ms = 0
+    # 连接的发送缓冲区超过这个字节数时(客户端读取太慢)，暂停读取这个连接的请求，直到发送完。0代表不暂停
+    conn_write_pause_size = 1024 * 1024
+    # 连接的发送缓冲区超过这个字节数时直接断开，0代表不限制
+    conn_write_buffer_max_size = 64 * 1024 * 1024
+
+    # 连接数上限，超过时直接断开新连接，0代表不限制。多acceptor时为每个acceptor的上限，见 admission.py
+    max_connections = 0
+    max_connections_per_ip = 0
+    # 令牌桶限速，每秒的帧数/字节数，0代表不限制
+    conn_rate_limit_frames = 0
+    conn_rate_limit_bytes = 0
+    ip_rate_limit_frames = 0
+    ip_rate_limit_bytes = 0
+    # 令牌桶的容量，为多少秒的速率
+    rate_limit_burst_seconds = 1
+    # 超过限速时的策略，pause: 暂停读取这个连接直到令牌足够; reject: 返回 RET_RATE_LIMITED
+    rate_limit_policy = 'pause'
+
+    # 大于0时，msg中的data达到这个字节数时放到共享内存中传输，队列中只传递位置，见 shm_arena.py
+    shm_payload_threshold = 0
+    # 共享内存的大小，不够时继续通过队列传输
+    shm_arena_size = 64 * 1024 * 1024
+
+    # route上设置了 cache_ttl 时，master中返回缓存的字节数上限，0代表不开启，见 response_cache.py
+    response_cache_max_bytes = 64 * 1024 * 1024
+
+    # 过载的group是否已经恢复的检查间隔(秒)
+    overload_check_interval = 0.01
+
+    # 大于1时，启动多个acceptor进程通过 SO_REUSEPORT 监听同一个端口，共用worker
+    acceptor_count = 1
+
+    # 管理端口，不为None时开启，可以获取prometheus格式的指标，见 admin.py
+    # 多acceptor时，每个acceptor监听 admin_port + acceptor_index，worker和master的指标只汇总到acceptor 0
+    admin_host = constants.ADMIN_HOST
+    admin_port = None
+    # worker把指标发给master的间隔(秒)，0代表不发送。多acceptor时master也按这个间隔把自己的指标发给acceptor 0
+    metrics_report_interval = 1
+
+    # 性能分析，见 profiler.py
+    # 向master/acceptor/worker进程发送 profile_signal 信号，或者使用admin的profile命令开启
+    # 统计 profile_duration 秒之后输出到 profile_dir
+    profile_dir = '/tmp'
+    # cprofile 或 sample
+    profile_mode = 'cprofile'
+    profile_duration = 10
+    # sample 模式的采样间隔(秒)
+    profile_sample_interval = 0.005
+    profile_signal = signal.SIGUSR1
+
+    # 子进程退出时由SIGCHLD唤醒立即重启
+    # 启动后 restart_min_uptime 秒内就退出的，认为在反复崩溃，重启前等待 restart_backoff_base 秒，每次翻倍，最多 restart_backoff_max 秒
+    restart_min_uptime = 5
+    restart_backoff_base = 0.1
+    restart_backoff_max = 30
+    # 没有收到SIGCHLD时，检查子进程的最长间隔(秒)
+    supervise_max_interval = 5
+
+    # 平滑重启worker，收到 reload_signal 或者admin的reload命令时触发，master保持监听和所有连接
+    # 逐个group启动新的worker，新的worker准备好之后，旧的worker处理完已经读取的请求后退出
+    reload_signal = signal.SIGHUP
+    # 等待新worker准备好的最长时间(秒)，超时则放弃重启
+    reload_ready_timeout = 30
+    # 等待旧worker退出的最长时间(秒)，超时则强制结束
+    reload_drain_timeout = 30
+    # 新worker中重新加载的模块名，已注册路由的view_func会替换为重新加载后模块中的同名函数
+    reload_modules = ()
+
+    # 自动伸缩的检查间隔(秒)，也是计算忙碌比例和平均处理时间的统计窗口，见 group_conf 中的 max_count
+    autoscale_interval = 1
+
+    # 检查worker是否卡在一个请求中的间隔(秒)，见 group_conf 中的 hard_timeout
+    watchdog_interval = 1
     ############################## configurable end   ##############################
 
     connection_factory_class = ConnectionFactory
     request_class = Request
+    # master与worker之间的传输，需要实现 put_nowait、get，可以换成 shm_queue.ShmQueue
+    # 也可以在 group_conf 中用 queue_class 单独指定
+    queue_class = Queue
 
     got_first_request = False
 
+    # {group_id: [queue, ...]}，每个acceptor一个队列，index即acceptor_index
     parent_input_dict = None
+    # {group_id: [queue, ...]}，每个worker一个队列时，index即worker_index
     parent_output_dict = None
+    dispatcher_dict = None
+    # {conn_id: conn}，连接断开时删除
     conn_dict = None
 
     server = None
     blueprints = None
+    # worker启动时由 build_dispatch_tables 生成
+    # {cmd: dict(blueprint, route_rule, before_request, after_request)}
+    route_table = None
+    # {event_name: (handler, ...)}，app和所有blueprint的回调按调用顺序展开
+    hook_table = None
+    # 网络层，run 时创建
+    frontend = None
+    # 当前进程的acceptor序号
+    acceptor_index = 0
+    # master汇总的指标
+    metrics = None
+    # admin端口支持的命令 {name: func(args)}
+    admin_commands = None
+    # 当前进程的profiler，网络层运行时创建
+    profiler = None
+    # 收到退出信号之后，不再重启子进程
+    _stopping = False
+    # worker的代数，每次平滑重启加1
+    worker_generation = 0
+    _reload_requested = False
+    # 管理子进程的进程
+    _master_pid = None
+    # {(group_id, worker_index): pid}，只在管理worker的进程中有效
+    worker_pid_dict = None
+    # {group_id: RawArray([处理请求的总耗时, 处理完的请求数] * slot数)}，worker累加，自动伸缩时读取
+    group_stats_dict = None
+    # {group_id: RawArray(每个处理线程正在处理的请求的开始时间，0代表空闲)}，worker写入，watchdog读取
+    group_running_dict = None
+    # 每个group的slot数为worker数上限的两倍，平滑重启时新旧worker同时运行，各自使用不同的slot
+    # {group_id: [空闲的slot, ...]}，只在管理worker的进程中有效
+    _free_slot_dict = None
+    # {group_id: 当前的worker数}，只在管理worker的进程中有效
+    group_count_dict = None
+    # 传输大数据的共享内存，shm_payload_threshold 大于0时才创建
+    shm_arena = None
+    # 连接准入和限速，配置了连接数上限或者限速时才创建
+    admission = None
+    # master中的返回缓存，有route设置了 cache_ttl 时才创建
+    response_cache = None
 
     def __init__(self, box_class, group_conf, group_router):
         """
@@ -55,11 +212,40 @@ class Melon(RoutesMixin, AppEventsMixin):
                     count: 10,
                     input_max_size: 1000,  # parent端的input
                     output_max_size: 1000, # parent端的output
+                    batch_max_msgs: 0,      # 大于1时开启批量传输，一次IPC最多携带的msg数
+                    batch_max_delay_ms: 0,  # 批量传输时，msg最多等待的毫秒数。0代表在当前reactor循环/worker处理循环结束时发送
+                    queue_class: None,      # 不填则使用 Melon.queue_class
+                    dispatch: 'shared',     # 分发策略，见 dispatcher.DISPATCHER_CLASSES，也可以直接传入类
+                    high_watermark: 0,      # 大于0时开启过载保护，队列中的msg数量达到这个值时认为过载
+                    low_watermark: 0,       # 降到这个值时恢复，默认为 high_watermark 的一半
+                    overload_policy: 'pause',  # 过载时的策略，pause: 暂停发送请求的连接的读取; reject: 返回 RET_OVERLOAD
+                    concurrency: 1,         # 每个worker同时处理的请求数，大于1时使用多个线程，回调需要是线程安全的
+                    min_count: None,        # 自动伸缩时最少的worker数，默认为count
+                    max_count: None,        # 大于 min_count 时开启自动伸缩，worker数在两者之间调整，count为初始数量
+                    scale_up_depth: 0,      # 队列中平均每个worker的msg数达到这个值时扩容，0代表不检查
+                    scale_up_busy: 0.8,     # worker忙碌比例(处理请求的时间/统计窗口)达到这个值时扩容，0代表不检查
+                    scale_up_latency: 0,    # 请求平均处理时间(秒)达到这个值时扩容，0代表不检查
+                    scale_down_busy: 0.3,   # 队列为空并且忙碌比例低于这个值时缩容
+                    scale_step: 1,          # 每次扩容的worker数，缩容每次1个
+                    scale_up_cooldown: 10,  # 距离上次伸缩多少秒之后才能扩容
+                    scale_down_cooldown: 60,  # 距离上次伸缩多少秒之后才能缩容
+                    deadline: 0,            # 请求从master收到到worker开始处理的最长时间(秒)，超过则返回 RET_DEADLINE_EXCEEDED，0代表不限制。route上也可以单独设置
+                    hard_timeout: 0,        # worker处理一个请求超过这个时间(秒)时，认为已经卡住，结束并重启worker，0代表不检查
+                                            # 只支持 concurrency 为1的group
+                    priorities: 1,          # 大于1时开启优先级，每个队列分为多个lane，worker先读取高优先级的lane，0的优先级最高
+                    default_priority: None, # route和group_router都没有指定优先级时使用，默认为 priorities / 2
+                    lane_starvation_limit: 8,  # 低优先级的lane被跳过这么多次之后，优先读取一次
                 }
             }
         :param group_router: 通过box路由group_id:
             def group_router(box):
                 return group_id
+            也可以同时返回 consistent_hash 分发时使用的key，不返回则使用conn_id:
+            def group_router(box):
+                return group_id, key
+            开启了priorities的group，还可以返回优先级，key为None时使用conn_id:
+            def group_router(box):
+                return group_id, key, priority
         :return:
         """
         RoutesMixin.__init__(self)
@@ -73,12 +259,49 @@ class Melon(RoutesMixin, AppEventsMixin):
         # 0 不代表无穷大，看代码是 SEM_VALUE_MAX = 32767L
         self.parent_input_dict = dict()
         self.parent_output_dict = dict()
-        self.conn_dict = weakref.WeakValueDictionary()
+        self.dispatcher_dict = dict()
+        self.conn_dict = dict()
+        # conn_id 高位为每个master进程随机生成的代号，低位为递增的序号
+        self._conn_id_generation = int(os.urandom(2).encode('hex'), 16)
+        self._conn_id_counter = itertools.count(1)
+        # 批量发往worker的msg: {(group_id, queue_index): [msg, ...]}
+        self._group_batch_dict = dict()
+        self._group_batch_timer_dict = dict()
+        # 过载的group: {group_id: set(因此暂停读取的conn_id)}
+        self._overload_group_dict = dict()
+        self._overload_check_timer = None
+        # 有合并待发送数据的连接 {conn_id: conn}
+        self._write_pending_conn_dict = dict()
+        self._write_flush_timer = None
+        self.metrics = Metrics()
+        self.admin_commands = dict(
+            metrics=self.render_metrics,
+            profile=self._admin_profile,
+            reload=self._admin_reload,
+            cache_invalidate=self._admin_cache_invalidate,
+        )
+        self.worker_pid_dict = dict()
+        self.group_stats_dict = dict()
+        self.group_running_dict = dict()
+        self.group_reading_dict = dict()
+        self._free_slot_dict = dict()
+        self.group_count_dict = dict()
+        # 正在退出的缩容worker [(process, 强制结束的时间, worker)]，退出之后释放slot
+        self._retiring_list = []
+        # 需要强制结束，但是正在读取队列的worker [(process, worker, 是否释放slot)]，见 _terminate_worker
+        self._terminating_list = []
+        # 自动伸缩的状态 {group_id: dict(time, busy, handled, scale_time)}
+        self._autoscale_state_dict = dict()
+        # admin发给worker的profile参数 "mode duration"，worker收到信号时读取
+        self._profile_args = RawArray('c', 64)
 
     def register_blueprint(self, blueprint):
         blueprint.register_to_app(self)
 
-    def run(self, host=None, port=None, debug=None):
+    def run(self, host=None, port=None, debug=None, frontend=None):
+        """
+        :param frontend: twisted 或 asyncio，不传则使用 frontend_name
+        """
         self._validate_cmds()
 
         if host is None:
@@ -87,28 +310,88 @@ class Melon(RoutesMixin, AppEventsMixin):
             port = constants.SERVER_PORT
         if debug is not None:
             self.debug = debug
+        if frontend is not None:
+            self.frontend_name = frontend
 
         def run_wrapper():
-            logger.info('Running server on %s:%s, debug: %s',
-                        host, port, self.debug)
+            logger.info('Running server on %s:%s, debug: %s, frontend: %s, acceptor_count: %s',
+                        host, port, self.debug, self.frontend_name, self.acceptor_count)
 
             setproctitle.setproctitle(self.make_proc_name('master'))
+            if self.shm_payload_threshold > 0:
+                self.shm_arena = ShmArena(self.shm_arena_size)
             self._init_groups()
+            self._master_pid = os.getpid()
+            self._handle_child_signals()
+
+            if self.acceptor_count > 1:
+                # master只负责管理acceptor和worker进程
+                self._handle_master_signals()
+                self._fork_workers(host, port)
+            else:
+                self._spawn_fork_workers()
+                self._run_frontend(host, port)
+
+        run_wrapper()
+
+    def _run_frontend(self, host, port):
+        """
+        在当前进程中监听端口并运行网络层
+        """
+        self.frontend = get_frontend_class(self.frontend_name)(self)
+        if any((self.max_connections, self.max_connections_per_ip,
+                self.conn_rate_limit_frames, self.conn_rate_limit_bytes,
+                self.ip_rate_limit_frames, self.ip_rate_limit_bytes)):
+            self.admission = AdmissionControl(self)
+            self.frontend.looping_call(self.admission.sweep_interval, self.admission.sweep)
+        if self.response_cache_max_bytes > 0 and self._has_cached_routes():
+            self.response_cache = ResponseCache(self.response_cache_max_bytes)
+        self.profiler = Profiler('master' if self.acceptor_count == 1 else 'acceptor-%s' % self.acceptor_index,
+                                 self.profile_dir)
+
+        if self.read_worker_result_in_reactor:
+            self._add_worker_result_readers()
+        else:
             self._spawn_poll_worker_result_thread()
-            self._spawn_fork_workers()
-            self._handle_parent_proc_signals()
+        self._handle_parent_proc_signals()
 
-            reactor.listenTCP(port, self.connection_factory_class(self),
-                              backlog=self.backlog, interface=host)
+        self.server = self.frontend.listen(host, port, self.backlog, reuse_port=self.acceptor_count > 1)
+        if self.admin_port is not None:
+            self.frontend.listen_admin(self.admin_host, self.admin_port + self.acceptor_index)
 
-            try:
-                reactor.run(installSignalHandlers=False)
-            except KeyboardInterrupt:
-                pass
-            except:
-                logger.error('exc occur.', exc_info=True)
+        try:
+            self.frontend.run()
+        except KeyboardInterrupt:
+            pass
+        except:
+            logger.error('exc occur.', exc_info=True)
 
-        run_wrapper()
+    def _run_acceptor(self, acceptor_index, host, port):
+        """
+        acceptor进程
+        """
+        setproctitle.setproctitle(self.make_proc_name('acceptor:%s' % acceptor_index))
+        self.acceptor_index = acceptor_index
+        # 重启的acceptor不能再分配之前用过的conn_id，队列里残留的返回也会因为代号不一致被丢弃
+        master_generation = self._conn_id_generation
+        while self._conn_id_generation == master_generation:
+            self._conn_id_generation = int(os.urandom(2).encode('hex'), 16)
+        self._conn_id_counter = itertools.count(1)
+        # master中还没有发出去的指标由master发送，不能重复统计
+        self.metrics = Metrics()
+
+        for queues in self.parent_input_dict.values():
+            queue = queues[acceptor_index]
+            if hasattr(queue, '_rlock'):
+                # multiprocessing.Queue: 上一个acceptor可能阻塞在get中，持有读锁时被kill，锁永远不会释放
+                # acceptor是这个队列唯一的读者，换成当前进程自己的锁
+                queue._rlock = Lock()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(self.reload_signal, signal.SIG_IGN)
+        signal.set_wakeup_fd(-1)
+
+        get_frontend_class(self.frontend_name).reinstall()
+        self._run_frontend(host, port)
 
     def make_proc_name(self, subtitle):
         """
@@ -140,14 +423,368 @@ class Melon(RoutesMixin, AppEventsMixin):
 
         assert not duplicate_cmds, 'duplicate cmds: %s' % duplicate_cmds
 
+    def build_dispatch_tables(self):
+        """
+        把路由和事件回调展开成查找表，处理请求时直接查表，不再遍历所有blueprint
+        没有注册回调的事件展开后为空tuple
+        worker启动时(create_worker回调之后)调用，之后再注册的路由和回调不会生效
+        :return:
+        """
+        def chain(slots):
+            return tuple(handler for slot in slots for handler in slot)
+
+        bp_events_list = [bp.events for bp in self.blueprints]
+
+        self.hook_table = dict(
+            before_first_request=chain(
+                [self.events.before_first_request] + [e.before_app_first_request for e in bp_events_list]
+            ),
+            before_response=chain(
+                [self.events.before_response] + [e.before_app_response for e in bp_events_list]
+            ),
+            after_response=chain(
+                [e.after_app_response for e in bp_events_list] + [self.events.after_response]
+            ),
+        )
+
+        before_request_slots = [self.events.before_request] + [e.before_app_request for e in bp_events_list]
+        after_request_slots = [e.after_app_request for e in bp_events_list] + [self.events.after_request]
+
+        route_table = dict()
+        for cmd, route_rule in self.rule_map.items():
+            route_table[cmd] = dict(
+                blueprint=None,
+                route_rule=route_rule,
+                before_request=chain(before_request_slots),
+                after_request=chain(after_request_slots),
+            )
+
+        for bp in self.blueprints:
+            for cmd, route_rule in bp.rule_map.items():
+                if cmd in route_table:
+                    # 和逐个查找时一样，app优先，其次是先注册的blueprint
+                    continue
+
+                route_table[cmd] = dict(
+                    blueprint=bp,
+                    route_rule=route_rule,
+                    before_request=chain(before_request_slots + [bp.events.before_request]),
+                    after_request=chain([bp.events.after_request] + after_request_slots),
+                )
+
+        self.route_table = route_table
+
     def _init_groups(self):
         """
         初始化group数据
         :return:
         """
         for group_id, conf in self.group_conf.items():
-            self.parent_input_dict[group_id] = Queue(conf.get('input_max_size', 0))
-            self.parent_output_dict[group_id] = Queue(conf.get('output_max_size', 0))
+            queue_class = conf.get('queue_class') or self.queue_class
+            self.parent_input_dict[group_id] = [queue_class(conf.get('input_max_size', 0))
+                                                for it in xrange(self.acceptor_count)]
+
+            dispatcher_class = conf.get('dispatch') or 'shared'
+            if not isinstance(dispatcher_class, type):
+                dispatcher_class = DISPATCHER_CLASSES[dispatcher_class]
+
+            count, min_count, max_count = get_group_counts(conf)
+
+            queue_factory = functools.partial(queue_class, conf.get('output_max_size', 0))
+            if conf.get('priorities', 1) > 1:
+                queue_factory = functools.partial(LaneQueue, conf['priorities'], queue_factory,
+                                                  conf.get('lane_starvation_limit', 8))
+
+            # 按worker数上限创建，没有启动的worker不参与分发
+            dispatcher = dispatcher_class(max_count, queue_factory)
+            for worker_index in xrange(count, max_count):
+                dispatcher.set_worker_alive(worker_index, False)
+
+            # 多acceptor时，分发状态在各个acceptor进程中，伸缩之后无法同步
+            assert max_count == min_count or self.acceptor_count == 1 or len(dispatcher.queues) == 1, \
+                'autoscale with multiple acceptors needs shared dispatch. group_id: %r' % group_id
+
+            # 多线程处理时，其他线程阻塞在读取中，持有队列的读锁，结束worker之后整个group都无法再读取
+            assert not conf.get('hard_timeout') or conf.get('concurrency', 1) == 1, \
+                'hard_timeout needs concurrency 1. group_id: %r' % group_id
+
+            self.dispatcher_dict[group_id] = dispatcher
+            self.parent_output_dict[group_id] = dispatcher.queues
+            # 初始的worker使用和worker_index相同的slot
+            self.group_stats_dict[group_id] = RawArray('d', max_count * 2 * 2)
+            self.group_running_dict[group_id] = RawArray('d', max_count * 2 * conf.get('concurrency', 1))
+            self.group_reading_dict[group_id] = RawArray('b', max_count * 2)
+            self._free_slot_dict[group_id] = range(count, max_count * 2)
+            self.group_count_dict[group_id] = count
+
+    def alloc_conn_id(self):
+        """
+        分配conn_id，保证不会重复
+        """
+        return (
+            (self._conn_id_generation << (constants.CONN_ID_SEQ_BITS + constants.CONN_ID_ACCEPTOR_BITS)) |
+            (self.acceptor_index << constants.CONN_ID_SEQ_BITS) |
+            next(self._conn_id_counter)
+        )
+
+    def check_overload(self, group_id, conn):
+        """
+        group队列中的msg达到 high_watermark 之后，直到降到 low_watermark 之前:
+            pause: 暂停往这个group发送请求的连接的读取，当前的msg仍然发送
+            reject: 拒绝所有发往这个group的请求
+        :param group_id:
+        :param conn: 发送请求的连接
+        :return: False 代表需要拒绝这个请求
+        """
+        conf = self.group_conf[group_id]
+        high_watermark = conf.get('high_watermark', 0)
+        if high_watermark <= 0:
+            return True
+
+        conn_ids = self._overload_group_dict.get(group_id)
+        if conn_ids is None:
+            depth = self.get_group_depth(group_id)
+            if depth < high_watermark:
+                return True
+
+            logger.error('group overload. group_id: %r, depth: %s', group_id, depth)
+            conn_ids = self._overload_group_dict[group_id] = set()
+            if not self._overload_check_timer:
+                self._overload_check_timer = self.frontend.looping_call(self.overload_check_interval,
+                                                                        self._check_overload_groups)
+
+        if conf.get('overload_policy') == 'reject':
+            self.metrics.incr('melon_overload_rejected_total', (('group', group_id),))
+            return False
+
+        if conn.conn_id not in conn_ids:
+            conn_ids.add(conn.conn_id)
+            conn.pause_reading(group_id)
+            self.metrics.incr('melon_overload_paused_total', (('group', group_id),))
+
+        return True
+
+    def get_group_depth(self, group_id):
+        """
+        group中还没有被worker读取的msg数量，包括还没有批量发送的
+        """
+        depth = self.dispatcher_dict[group_id].qsize()
+
+        for (batch_group_id, queue_index, priority), batch in self._group_batch_dict.items():
+            if batch_group_id == group_id:
+                depth += len(batch)
+
+        return depth
+
+    def _check_overload_groups(self):
+        """
+        过载的group降到 low_watermark 之后，恢复对应连接的读取
+        """
+        for group_id, conn_ids in self._overload_group_dict.items():
+            conf = self.group_conf[group_id]
+            low_watermark = conf.get('low_watermark') or conf['high_watermark'] / 2
+
+            if self.get_group_depth(group_id) > low_watermark:
+                continue
+
+            logger.error('group recover. group_id: %r, paused conns: %s', group_id, len(conn_ids))
+            self._overload_group_dict.pop(group_id)
+
+            for conn_id in conn_ids:
+                conn = self.conn_dict.get(conn_id)
+                if conn:
+                    conn.resume_reading(group_id)
+
+        if not self._overload_group_dict:
+            self._overload_check_timer.stop()
+            self._overload_check_timer = None
+
+    def get_priority(self, group_id, box):
+        """
+        按route上的配置获取请求的优先级，没有开启priorities的group都为0
+        """
+        conf = self.group_conf[group_id]
+        lane_count = conf.get('priorities', 1)
+        if lane_count <= 1:
+            return 0
+
+        if self.route_table is None:
+            self.build_dispatch_tables()
+
+        route_entry = self.route_table.get(getattr(box, 'cmd', None))
+        priority = route_entry and route_entry['route_rule'].get('priority')
+        if priority is None:
+            priority = conf.get('default_priority')
+            if priority is None:
+                priority = lane_count / 2
+
+        return priority
+
+    def _has_cached_routes(self):
+        """
+        是否有route设置了 cache_ttl，需要在run之前注册
+        """
+        if self.route_table is None:
+            self.build_dispatch_tables()
+
+        return any(route_entry['route_rule'].get('cache_ttl') for route_entry in self.route_table.values())
+
+    def get_cache_key(self, box, data, header=None):
+        """
+        请求对应的缓存key，route没有设置 cache_ttl 时返回None
+        :param data: 原始数据
+        :param header: peek_box_header 模式下解析出的包头，需要还原出包体
+        """
+        route_entry = self.route_table.get(getattr(box, 'cmd', None))
+        if not route_entry or not route_entry['route_rule'].get('cache_ttl'):
+            return None
+
+        if header is not None:
+            restore_box(box, header, data)
+
+        key_func = route_entry['route_rule'].get('cache_key')
+        key = key_func(box) if key_func else box.body
+        if key is None:
+            return None
+
+        return '%s:%s' % (box.cmd, key)
+
+    def reply_from_cache(self, conn, box, cache_key):
+        """
+        命中缓存时直接返回给连接
+        :return: 是否命中
+        """
+        rsp_box = self.response_cache.get(cache_key)
+        if rsp_box is None:
+            self.metrics.incr('melon_response_cache_total', (('result', 'miss'),))
+            return False
+
+        self.metrics.incr('melon_response_cache_total', (('result', 'hit'),))
+        # 缓存的是第一次请求的返回，sn要换成这次请求的
+        rsp_box.sn = box.sn
+        if conn.queue_write(rsp_box.pack()):
+            self._write_pending_conn_dict[conn.conn_id] = conn
+            self._schedule_flush_conn_writes()
+
+        return True
+
+    def _fill_response_cache(self, cache_info, data):
+        """
+        :param cache_info: worker返回的 (key, epoch, ttl)
+        """
+        cache_key, epoch, ttl = cache_info
+        if epoch != self.response_cache.epoch:
+            # 请求发出之后有过删除，这个返回可能已经过期
+            return
+
+        rsp_box = self.box_class()
+        if rsp_box.unpack(data) > 0:
+            self.response_cache.set(cache_key, rsp_box, len(data), ttl)
+
+    def invalidate_cache(self, key=None, prefix=None):
+        """
+        删除当前进程中的返回缓存，worker中请使用 request.invalidate_cache
+        :return: 删除的数量
+        """
+        if not self.response_cache:
+            return 0
+
+        count = self.response_cache.invalidate(key, prefix)
+        self.metrics.incr('melon_response_cache_invalidated_total', (), count)
+        return count
+
+    def put_to_group(self, group_id, msg, key=None, priority=0):
+        """
+        把msg发给group对应的worker
+        开启了批量传输时，msg会先缓存起来，在当前reactor循环结束、超时或者达到batch_max_msgs时一起发送
+        :param group_id:
+        :param msg:
+        :param key: 分发使用的key，不传则使用conn_id
+        :param priority: 开启了priorities时，放入的lane
+        :return: 是否成功
+        """
+        dispatcher = self.dispatcher_dict[group_id]
+        queue_index = dispatcher.select(msg, msg.get('conn_id') if key is None else key)
+
+        if self.shm_arena and len(msg.get('data') or '') >= self.shm_payload_threshold:
+            handle = self.shm_arena.put(msg['data'])
+            if handle:
+                msg['data'] = None
+                msg['shm'] = handle
+                self.metrics.incr('melon_shm_payloads_total', (('group', group_id), ('direction', 'request')))
+
+        if self.compact_msg:
+            msg = envelope.pack(msg)
+
+        batch_max_msgs = self.group_conf[group_id].get('batch_max_msgs', 0)
+
+        if batch_max_msgs <= 1:
+            try:
+                self._put_to_queue(group_id, queue_index, msg, priority)
+            except:
+                logger.error('exc occur. msg: %r', msg, exc_info=True)
+                if self.shm_arena:
+                    release_msgs(self.shm_arena, msg)
+                self.metrics.incr('melon_dispatch_failed_total', (('group', group_id),))
+                return False
+
+            dispatcher.on_dispatch(queue_index)
+            self.metrics.incr('melon_dispatched_total', (('group', group_id),))
+            return True
+
+        batch_key = (group_id, queue_index, priority)
+        batch = self._group_batch_dict.setdefault(batch_key, [])
+        batch.append(msg)
+
+        if len(batch) >= batch_max_msgs:
+            return self._flush_group_batch(batch_key)
+
+        if batch_key not in self._group_batch_timer_dict:
+            delay = self.group_conf[group_id].get('batch_max_delay_ms', 0) / 1000.0
+            self._group_batch_timer_dict[batch_key] = self.frontend.call_later(
+                delay, self._flush_group_batch, batch_key)
+
+        return True
+
+    def _flush_group_batch(self, batch_key):
+        """
+        把缓存的msg一次性发给worker
+        :param batch_key: (group_id, queue_index, priority)
+        :return: 是否成功
+        """
+        timer = self._group_batch_timer_dict.pop(batch_key, None)
+        if timer:
+            self.frontend.cancel_call(timer)
+
+        batch = self._group_batch_dict.pop(batch_key, None)
+        if not batch:
+            return True
+
+        group_id, queue_index, priority = batch_key
+
+        try:
+            # list 代表一批msg，worker端会自动拆开
+            self._put_to_queue(group_id, queue_index, batch if len(batch) > 1 else batch[0], priority)
+        except:
+            logger.error('exc occur. group_id: %r, batch len: %s', group_id, len(batch), exc_info=True)
+            if self.shm_arena:
+                release_msgs(self.shm_arena, batch)
+            self.metrics.incr('melon_dispatch_failed_total', (('group', group_id),), len(batch))
+            return False
+
+        for it in xrange(len(batch)):
+            self.dispatcher_dict[group_id].on_dispatch(queue_index)
+        self.metrics.incr('melon_dispatched_total', (('group', group_id),), len(batch))
+        return True
+
+    def _put_to_queue(self, group_id, queue_index, obj, priority):
+        queue = self.parent_output_dict[group_id][queue_index]
+
+        if isinstance(queue, LaneQueue):
+            # 超出范围的优先级放到最近的lane
+            queue.put_nowait(obj, min(max(priority, 0), len(queue.queues) - 1))
+        else:
+            queue.put_nowait(obj)
 
     def _spawn_poll_worker_result_thread(self):
         """
@@ -158,6 +795,17 @@ class Melon(RoutesMixin, AppEventsMixin):
             thread.daemon = True
             thread.start()
 
+    def _add_worker_result_readers(self):
+        """
+        把获取worker数据的队列注册到reactor上
+        """
+        for group_id in self.group_conf:
+            reader = QueueReader(self.frontend,
+                                 self.parent_input_dict[group_id][self.acceptor_index],
+                                 functools.partial(self._handle_worker_responses, group_id),
+                                 self.worker_result_max_batch)
+            reader.startReading()
+
     def _spawn_fork_workers(self):
         """
         通过线程启动多个worker
@@ -166,87 +814,831 @@ class Melon(RoutesMixin, AppEventsMixin):
         thread.daemon = True
         thread.start()
 
-    def _fork_workers(self):
-        def start_worker_process(target):
-            inner_p = Process(target=target)
-            inner_p.daemon = True
-            inner_p.start()
-            return inner_p
-
+    def _fork_workers(self, host=None, port=None):
+        """
+        启动并管理worker进程，多acceptor时还要管理acceptor进程
+        """
         p_list = []
 
+        if self.acceptor_count > 1:
+            # 先于worker启动，这时候master中还没有其他线程
+            for acceptor_index in xrange(self.acceptor_count):
+                target = functools.partial(self._run_acceptor, acceptor_index, host, port)
+                p_list.append(self._start_process(target, labels=(('acceptor', acceptor_index),)))
+
         for group_id, conf in self.group_conf.items():
 
-            child_input = self.parent_output_dict[group_id]
+            dispatcher = self.dispatcher_dict[group_id]
             child_output = self.parent_input_dict[group_id]
-            worker = Worker(self, group_id, child_input, child_output)
 
-            for it in xrange(0, conf.get('count', 1)):
-                p = start_worker_process(worker.run)
-                p_list.append(dict(
-                    p=p,
-                    worker=worker
-                ))
+            for worker_index in xrange(0, self.group_count_dict[group_id]):
+                child_input = self.parent_output_dict[group_id][dispatcher.get_worker_queue_index(worker_index)]
+                worker = Worker(self, group_id, child_input, child_output, worker_index)
+                p_list.append(self._start_process(worker.run, worker=worker))
+
+        autoscale_enabled = any(min_count < max_count for count, min_count, max_count
+                                in map(get_group_counts, self.group_conf.values()))
+        autoscale_time = time.time() + self.autoscale_interval
+        watchdog_enabled = any(conf.get('hard_timeout') for conf in self.group_conf.values())
+        watchdog_time = time.time() + self.watchdog_interval
+        # 多acceptor时master没有admin端口，进程重启、伸缩等指标要发给acceptor
+        report_enabled = self.acceptor_count > 1 and self.metrics_report_interval > 0
+        report_time = time.time() + self.metrics_report_interval
 
         while 1:
-            for info in p_list:
-                p = info['p']
-                worker = info['worker']
+            timeout = self._check_processes(p_list)
 
-                if not p.is_alive():
-                    old_pid = p.pid
-                    p = start_worker_process(worker.run)
-                    info['p'] = p
+            if autoscale_enabled and not self._stopping:
+                now = time.time()
+                if now >= autoscale_time:
+                    autoscale_time = now + self.autoscale_interval
+                    safe_call(self._autoscale_groups, p_list)
+                timeout = min(timeout, max(autoscale_time - now, 0))
 
-                    logger.error('process[%s] is dead. start new process[%s]. worker: %s', old_pid, p.pid, worker)
+            if watchdog_enabled and not self._stopping:
+                now = time.time()
+                if now >= watchdog_time:
+                    watchdog_time = now + self.watchdog_interval
+                    safe_call(self._check_stuck_workers, p_list)
+                timeout = min(timeout, max(watchdog_time - now, 0))
+
+            if report_enabled:
+                now = time.time()
+                if now >= report_time:
+                    report_time = now + self.metrics_report_interval
+                    safe_call(self._report_master_metrics)
+                timeout = min(timeout, max(report_time - now, 0))
+
+            if self._reload_requested and not self._stopping:
+                self._reload_requested = False
+                safe_call(self._reload_workers, p_list)
+                continue
 
             try:
-                time.sleep(1)
+                self._wait_child_signal(timeout)
             except KeyboardInterrupt:
                 break
             except:
                 logger.error('exc occur.', exc_info=True)
                 break
 
+    def _start_process(self, target, worker=None, labels=None):
+        """
+        启动子进程
+        :return: 进程信息 dict(p, target, worker, start_time, restart_time, backoff, labels)
+        """
+        if worker:
+            # 之前的进程可能在持有ipc_lock时退出
+            worker.ipc_lock = Lock()
+
+        p = Process(target=target)
+        p.daemon = True
+        p.start()
+
+        if worker:
+            self.worker_pid_dict[(worker.group_id, worker.worker_index)] = p.pid
+
+        return dict(
+            p=p,
+            target=target,
+            worker=worker,
+            start_time=time.time(),
+            restart_time=None,
+            backoff=0,
+            labels=labels or (('group', worker.group_id),),
+        )
+
+    def _check_processes(self, p_list):
+        """
+        重启已经退出的子进程
+        :return: 下次需要检查的最长等待时间
+        """
+        self._check_terminating_workers()
+
+        now = time.time()
+        timeout = self.supervise_max_interval
+
+        for info in p_list:
+            p = info['p']
+            worker = info['worker']
+
+            if p and not p.is_alive():
+                # 多acceptor时，分发状态在各个acceptor进程中，worker会继续读取原来的队列
+                if worker and self.frontend:
+                    dispatcher = self.dispatcher_dict[worker.group_id]
+                    self.frontend.call_from_thread(dispatcher.set_worker_alive, worker.worker_index, False)
+
+                if now - info['start_time'] >= self.restart_min_uptime:
+                    info['backoff'] = 0
+
+                # 第一次立即重启，之后还是很快退出的话，等待时间翻倍
+                info['p'] = None
+                info['restart_time'] = now + info['backoff']
+                self.metrics.incr('melon_process_exits_total', info['labels'])
+
+                logger.error('process[%s] is dead. exitcode: %s, restart after %ss. worker: %s',
+                             p.pid, p.exitcode, info['backoff'], worker)
+
+                info['backoff'] = min(info['backoff'] * 2 or self.restart_backoff_base, self.restart_backoff_max)
+
+            if info['p'] or self._stopping:
+                continue
+
+            if info['restart_time'] > now:
+                timeout = min(timeout, info['restart_time'] - now)
+                continue
+
+            new_info = self._start_process(info['target'], worker, info['labels'])
+            info['p'] = p = new_info['p']
+            info['start_time'] = new_info['start_time']
+            self.metrics.incr('melon_process_restarts_total', info['labels'])
+
+            if worker and self.frontend:
+                # 重新分配
+                dispatcher = self.dispatcher_dict[worker.group_id]
+                self.frontend.call_from_thread(dispatcher.set_worker_alive, worker.worker_index, True)
+
+            logger.error('start new process[%s]. worker: %s', p.pid, worker)
+
+        return timeout
+
+    def _supervise_until(self, p_list, condition, timeout):
+        """
+        等待condition成立，期间继续管理子进程
+        :return: condition是否成立
+        """
+        deadline = time.time() + timeout
+
+        while not condition():
+            now = time.time()
+            if now >= deadline or self._stopping:
+                return False
+
+            self._wait_child_signal(min(self._check_processes(p_list), deadline - now, 0.1))
+
+        return True
+
+    def _reload_workers(self, p_list):
+        """
+        逐个group平滑重启worker:
+            1. 启动新的worker，和旧的worker读取同样的队列
+            2. 新的worker全部准备好之后，通知旧的worker退出，旧的worker会先处理完已经读取的请求
+            3. 超过 reload_drain_timeout 还没有退出的旧worker，强制结束
+        新的worker没有全部准备好时，放弃这次重启，旧的worker继续运行
+        """
+        self.worker_generation += 1
+        logger.error('reload workers begin. generation: %s', self.worker_generation)
+
+        for group_id in self.group_conf:
+            old_infos = [info for info in p_list if info['worker'] and info['worker'].group_id == group_id]
+
+            new_infos = []
+            for old_info in old_infos:
+                old_worker = old_info['worker']
+                worker = Worker(self, group_id, old_worker.child_input, old_worker.child_output,
+                                old_worker.worker_index, self.worker_generation,
+                                self._alloc_worker_slot(group_id, old_worker.worker_index))
+                new_infos.append(self._start_process(worker.run, worker=worker))
+            p_list.extend(new_infos)
+
+            if not self._supervise_until(p_list,
+                                         lambda: all(info['worker'].ready_event.is_set() for info in new_infos),
+                                         self.reload_ready_timeout):
+                logger.error('reload workers fail, new workers not ready. group_id: %r', group_id)
+                for info in new_infos:
+                    p_list.remove(info)
+                    if info['p']:
+                        # 已经准备好的worker可能阻塞在读取中，先通知退出
+                        self._stop_worker(info['worker'], info['p'].pid, self.reload_drain_timeout)
+                        self._terminate_worker(info['p'], info['worker'], release_slot=True)
+                    else:
+                        self._release_worker_slot(info['worker'])
+                for info in old_infos:
+                    self.worker_pid_dict[(group_id, info['worker'].worker_index)] = info['p'] and info['p'].pid
+                return False
+
+            # 旧的worker不再重启
+            old_p_list = []
+            for info in old_infos:
+                p_list.remove(info)
+                if not info['p']:
+                    self._release_worker_slot(info['worker'])
+                    continue
+
+                old_p_list.append(info['p'])
+                self._stop_worker(info['worker'], info['p'].pid, self.reload_drain_timeout)
+
+            self._supervise_until(p_list, lambda: not any(p.is_alive() for p in old_p_list), self.reload_drain_timeout)
+
+            for info in old_infos:
+                p = info['p']
+                if not p:
+                    continue
+
+                if p.is_alive():
+                    logger.error('old worker[%s] drain timeout, terminate. group_id: %r', p.pid, group_id)
+                    self._terminate_worker(p, info['worker'], release_slot=True)
+                else:
+                    p.join()
+                    self._release_worker_slot(info['worker'])
+
+            self.metrics.incr('melon_reload_total', (('group', group_id),))
+            logger.error('reload group done. group_id: %r, workers: %s', group_id, len(new_infos))
+
+        return True
+
+    def _alloc_worker_slot(self, group_id, worker_index):
+        """
+        给新启动的worker分配统计使用的slot
+        """
+        free_slots = self._free_slot_dict[group_id]
+        if not free_slots:
+            # 正在退出的worker太多，只能和同一个worker_index的初始slot共用，统计可能不准确
+            logger.error('no free worker slot. group_id: %r, worker_index: %s', group_id, worker_index)
+            return worker_index
+
+        return free_slots.pop(0)
+
+    def _release_worker_slot(self, worker):
+        """
+        worker进程已经退出之后，才能把slot给其他worker使用
+        """
+        free_slots = self._free_slot_dict[worker.group_id]
+        if worker.slot not in free_slots:
+            free_slots.append(worker.slot)
+
+    def _stop_worker(self, worker, pid, timeout):
+        """
+        通知worker处理完已经读取的请求后退出
+        worker的读取在 _read_lock 中，一个处理线程读到stop之后，其他处理线程也会退出，所以只需要放入一个
+        队列可能和其他worker共用，stop只对pid和slot都一致的worker生效
+        超过timeout之后master会强制结束这个worker，还没有被读取的stop也不再有用，读到的worker直接丢弃
+        """
+        worker.child_input.put_nowait(dict(ctrl='stop', pid=pid, slot=worker.slot, expire_time=time.time() + timeout))
+
+    def _report_master_metrics(self):
+        """
+        多acceptor时，把master中统计的指标发给acceptor 0，和worker的指标一样汇总
+        """
+        snapshot = self.metrics.pop_snapshot()
+        if not snapshot:
+            return
+
+        queue = self.parent_input_dict[self.group_conf.keys()[0]][0]
+        try:
+            queue.put_nowait(dict(ctrl='metrics', metrics=snapshot))
+        except:
+            logger.error('exc occur.', exc_info=True)
+
+    def _terminate_worker(self, p, worker, release_slot=False):
+        """
+        强制结束worker
+        worker在读写队列、共享内存时会持有和其他进程共用的锁，这时结束的话，共用的进程会一直阻塞
+        所以先占住worker的ipc_lock和队列的写锁(mp.Queue的feeder线程发送时持有)，并且worker没有阻塞在读取中，才能结束
+        不能结束时放入 _terminating_list，由 _check_terminating_workers 重试
+        :param release_slot: 结束之后是否释放slot，被重启的worker继续使用原来的slot
+        :return: 是否已经结束
+        """
+        if self._try_terminate_worker(p, worker):
+            if release_slot:
+                self._release_worker_slot(worker)
+            return True
+
+        logger.error('worker[%s] is in queue operation, terminate later. worker: %s', p.pid, worker)
+        self._terminating_list.append((p, worker, release_slot))
+        return False
+
+    def _try_terminate_worker(self, p, worker):
+        """
+        :return: 是否已经结束
+        """
+        lock_list = [worker.ipc_lock]
+        for queue in [worker.child_input] + list(worker.child_output):
+            # LaneQueue 由多个队列组成
+            for sub_queue in getattr(queue, 'queues', [queue]):
+                if getattr(sub_queue, '_wlock', None) is not None:
+                    lock_list.append(sub_queue._wlock)
+
+        acquired_list = []
+        try:
+            for lock in lock_list:
+                if not lock.acquire(True, 0.01):
+                    return False
+                acquired_list.append(lock)
+
+            if self.group_reading_dict[worker.group_id][worker.slot]:
+                return False
+
+            p.terminate()
+            # 退出之后才能释放锁
+            p.join()
+        finally:
+            for lock in reversed(acquired_list):
+                lock.release()
+
+        running = self.group_running_dict[worker.group_id]
+        for i in xrange(worker.slot * worker.concurrency, (worker.slot + 1) * worker.concurrency):
+            running[i] = 0
+        self.group_reading_dict[worker.group_id][worker.slot] = 0
+        return True
+
+    def _check_terminating_workers(self):
+        """
+        重试强制结束 _terminating_list 中的worker
+        """
+        terminating_list = self._terminating_list
+        self._terminating_list = []
+
+        for p, worker, release_slot in terminating_list:
+            if p.is_alive() and not self._try_terminate_worker(p, worker):
+                self._terminating_list.append((p, worker, release_slot))
+                continue
+
+            p.join()
+            if release_slot:
+                self._release_worker_slot(worker)
+
+    def _is_terminating(self, p):
+        return any(it[0] is p for it in self._terminating_list)
+
+    def _check_stuck_workers(self, p_list):
+        """
+        处理一个请求超过 hard_timeout 的worker，结束之后由 _check_processes 重启
+        """
+        now = time.time()
+
+        for info in p_list:
+            worker = info['worker']
+            p = info['p']
+            if not worker or not p:
+                continue
+
+            hard_timeout = self.group_conf[worker.group_id].get('hard_timeout', 0)
+            if hard_timeout <= 0:
+                continue
+
+            running = self.group_running_dict[worker.group_id]
+            begin_index = worker.slot * worker.concurrency
+            begin_times = [t for t in running[begin_index:begin_index + worker.concurrency] if t > 0]
+            if not begin_times or now - min(begin_times) <= hard_timeout or self._is_terminating(p):
+                continue
+
+            logger.error('worker[%s] stuck for %.1fs, terminate. worker: %s', p.pid, now - min(begin_times), worker)
+            self.metrics.incr('melon_worker_stuck_total', info['labels'])
+            self._terminate_worker(p, worker)
+
+    def _autoscale_groups(self, p_list):
+        """
+        根据队列长度、忙碌比例、平均处理时间增减worker
+        扩容和缩容都要等待冷却时间，避免来回抖动
+        """
+        now = time.time()
+
+        retiring_list = []
+        for p, deadline, worker in self._retiring_list:
+            if not p.is_alive():
+                p.join()
+                self._release_worker_slot(worker)
+            elif now >= deadline:
+                logger.error('retiring worker[%s] drain timeout, terminate.', p.pid)
+                self._terminate_worker(p, worker, release_slot=True)
+            else:
+                retiring_list.append((p, deadline, worker))
+        self._retiring_list = retiring_list
+
+        for group_id, conf in self.group_conf.items():
+            count, min_count, max_count = get_group_counts(conf)
+            if min_count >= max_count:
+                continue
+
+            infos = [info for info in p_list if info['worker'] and info['worker'].group_id == group_id]
+            count = len(infos)
+
+            stats = self.group_stats_dict[group_id]
+            busy = sum(stats[0::2])
+            handled = sum(stats[1::2])
+
+            state = self._autoscale_state_dict.get(group_id)
+            self._autoscale_state_dict[group_id] = dict(
+                time=now, busy=busy, handled=handled, scale_time=state['scale_time'] if state else now,
+            )
+            if state is None or now <= state['time'] or not count:
+                continue
+
+            busy_ratio = (busy - state['busy']) / ((now - state['time']) * count * conf.get('concurrency', 1))
+            latency = (busy - state['busy']) / (handled - state['handled']) if handled > state['handled'] else 0
+            depth = self.get_group_depth(group_id)
+
+            scale_up_depth = conf.get('scale_up_depth', 0)
+            scale_up_busy = conf.get('scale_up_busy', 0.8)
+            scale_up_latency = conf.get('scale_up_latency', 0)
+
+            overload = (
+                (scale_up_depth > 0 and depth >= scale_up_depth * count) or
+                (scale_up_busy > 0 and busy_ratio >= scale_up_busy) or
+                (scale_up_latency > 0 and latency >= scale_up_latency)
+            )
+            idle = not depth and busy_ratio < conf.get('scale_down_busy', 0.3)
+
+            if overload and count < max_count:
+                if now - state['scale_time'] < conf.get('scale_up_cooldown', 10):
+                    continue
+                new_count = min(count + conf.get('scale_step', 1), max_count)
+            elif idle and count > min_count:
+                if now - state['scale_time'] < conf.get('scale_down_cooldown', 60):
+                    continue
+                new_count = count - 1
+            else:
+                continue
+
+            logger.error('autoscale group. group_id: %r, count: %s -> %s, depth: %s, busy: %.2f, latency: %.4f',
+                         group_id, count, new_count, depth, busy_ratio, latency)
+
+            self._autoscale_state_dict[group_id]['scale_time'] = now
+            if new_count > count:
+                self._scale_up_group(p_list, group_id, infos, new_count)
+            else:
+                self._scale_down_group(p_list, group_id, infos, new_count)
+            self.group_count_dict[group_id] = new_count
+
+    def _scale_up_group(self, p_list, group_id, infos, new_count):
+        """
+        使用空闲的worker_index启动新的worker
+        """
+        dispatcher = self.dispatcher_dict[group_id]
+        used_indexes = set(info['worker'].worker_index for info in infos)
+        free_indexes = [i for i in xrange(dispatcher.worker_count) if i not in used_indexes]
+
+        for worker_index in free_indexes[:new_count - len(infos)]:
+            child_input = self.parent_output_dict[group_id][dispatcher.get_worker_queue_index(worker_index)]
+            worker = Worker(self, group_id, child_input, self.parent_input_dict[group_id], worker_index,
+                            self.worker_generation, self._alloc_worker_slot(group_id, worker_index))
+            p_list.append(self._start_process(worker.run, worker=worker))
+
+            if self.frontend:
+                self.frontend.call_from_thread(dispatcher.set_worker_alive, worker_index, True)
+
+            self.metrics.incr('melon_autoscale_total', (('group', group_id), ('direction', 'up')))
+
+    def _scale_down_group(self, p_list, group_id, infos, new_count):
+        """
+        worker_index最大的worker处理完队列中已有的msg之后退出
+        """
+        for info in sorted(infos, key=lambda x: x['worker'].worker_index)[new_count:]:
+            p_list.remove(info)
+            worker = info['worker']
+            self.worker_pid_dict.pop((group_id, worker.worker_index), None)
+
+            if info['p']:
+                self._retiring_list.append((info['p'], time.time() + self.reload_drain_timeout, worker))
+                if self.frontend:
+                    # 在reactor中先停止分发，再放入stop，保证队列中stop之前的msg都会被处理
+                    self.frontend.call_from_thread(self._retire_worker, worker, info['p'].pid)
+                else:
+                    self._retire_worker(worker, info['p'].pid)
+            else:
+                self._release_worker_slot(worker)
+                if self.frontend:
+                    self.frontend.call_from_thread(self.dispatcher_dict[group_id].set_worker_alive,
+                                                   worker.worker_index, False)
+
+            self.metrics.incr('melon_autoscale_total', (('group', group_id), ('direction', 'down')))
+
+    def _retire_worker(self, worker, pid):
+        """
+        停止向worker分发，并通知worker退出
+        """
+        dispatcher = self.dispatcher_dict[worker.group_id]
+        dispatcher.set_worker_alive(worker.worker_index, False)
+
+        queue_index = dispatcher.get_worker_queue_index(worker.worker_index)
+        for batch_key in self._group_batch_dict.keys():
+            if batch_key[:2] == (worker.group_id, queue_index):
+                self._flush_group_batch(batch_key)
+
+        self._stop_worker(worker, pid, self.reload_drain_timeout)
+
+    def _handle_child_signals(self):
+        """
+        子进程退出时，通过pipe唤醒管理子进程的线程
+        需要在主线程中调用，子进程中会恢复默认处理
+        """
+        self._child_signal_reader, self._child_signal_writer = os.pipe()
+        for fd in (self._child_signal_reader, self._child_signal_writer):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        # python的信号处理函数要等主线程执行时才会调用，主线程阻塞在reactor中时会有延迟
+        # wakeup_fd 在收到信号时立即由C层写入，其他信号也会写入，只是多检查一次
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.set_wakeup_fd(self._child_signal_writer)
+        # 避免其他线程中的阻塞调用因为SIGCHLD返回EINTR
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+        signal.signal(self.reload_signal, lambda signum, frame: self.request_reload())
+        signal.siginterrupt(self.reload_signal, False)
+
+    def request_reload(self):
+        """
+        通知管理子进程的线程开始平滑重启，可以在任何线程中调用
+        只能在master进程中调用，其他进程发送 reload_signal 给master
+        """
+        self._reload_requested = True
+        try:
+            os.write(self._child_signal_writer, '\0')
+        except OSError:
+            pass
+
+    def _wait_child_signal(self, timeout):
+        """
+        等待SIGCHLD，或者超时
+        """
+        try:
+            rlist = select.select([self._child_signal_reader], [], [], max(timeout, 0))[0]
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        if rlist:
+            try:
+                os.read(self._child_signal_reader, 4096)
+            except OSError:
+                pass
+
     def _poll_worker_result(self, group_id):
         """
         从队列里面获取worker的返回
+        每次阻塞等到第一条之后，把队列里已有的都取出来，一次性交给reactor
         """
+        queue = self.parent_input_dict[group_id][self.acceptor_index]
+
         while 1:
             try:
-                msg = self.parent_input_dict[group_id].get()
+                msg = queue.get()
+                msg_list = msg if isinstance(msg, list) else [msg]
+                msg_list.extend(drain_queue(queue, self.worker_result_max_batch - 1))
             except KeyboardInterrupt:
                 break
             except:
                 logger.error('exc occur.', exc_info=True)
                 break
 
-            # 参考 http://twistedsphinx.funsize.net/projects/core/howto/threading.html
-            reactor.callFromThread(self._handle_worker_response, msg)
+            self.frontend.call_from_thread(self._handle_worker_responses, group_id, msg_list)
+
+    def _handle_worker_responses(self, group_id, msg_list):
+        for msg in msg_list:
+            self._handle_worker_response(group_id, msg)
 
-    def _handle_worker_response(self, msg):
-        conn = self.conn_dict.get(msg.get('conn_id'))
+        self._schedule_flush_conn_writes()
+
+    def _schedule_flush_conn_writes(self):
+        if not self._write_pending_conn_dict or self._write_flush_timer:
+            return
+
+        if self.write_coalesce_delay_ms > 0:
+            self._write_flush_timer = self.frontend.call_later(self.write_coalesce_delay_ms / 1000.0,
+                                                               self._flush_conn_writes)
+        else:
+            self._flush_conn_writes()
+
+    def _flush_conn_writes(self):
+        """
+        发送所有连接合并的数据
+        """
+        self._write_flush_timer = None
+
+        conn_dict = self._write_pending_conn_dict
+        self._write_pending_conn_dict = dict()
+
+        for conn in conn_dict.values():
+            safe_call(conn.flush_writes)
+
+    def _handle_worker_response(self, group_id, msg):
+        if isinstance(msg, str):
+            msg = envelope.unpack(msg)
+
+        if 'shm' in msg:
+            # 读取之后立即释放，之后的处理和普通的返回一样
+            msg['data'] = self.shm_arena.get(msg.pop('shm'))
+
+        if 'ctrl' in msg:
+            # worker发来的控制消息，不是请求的返回
+            self._handle_ctrl_msg(group_id, msg)
+            return
+
+        self.dispatcher_dict[group_id].on_response(msg)
+
+        conn_id = msg.get('conn_id')
+        if (conn_id >> (constants.CONN_ID_SEQ_BITS + constants.CONN_ID_ACCEPTOR_BITS)) != self._conn_id_generation:
+            # 不是当前master分配的
+            logger.error('invalid conn_id generation. msg: %r', msg)
+            self.metrics.incr('melon_responses_dropped_total', (('group', group_id), ('reason', 'generation')))
+            return
+
+        conn = self.conn_dict.get(conn_id)
         data = msg.get('data')
 
+        if data and 'cache' in msg and self.response_cache:
+            self._fill_response_cache(msg['cache'], data)
+
+        if not conn:
+            self.metrics.incr('melon_responses_dropped_total', (('group', group_id), ('reason', 'closed')))
+
         if conn and conn.transport:
             try:
                 if data:
-                    conn.transport.write(data)
+                    if conn.queue_write(data):
+                        self._write_pending_conn_dict[conn_id] = conn
                 else:
-                    # data 为NULL代表关闭链接的意思
+                    # data 为NULL代表关闭链接的意思，之前的返回要先发出去
+                    conn.flush_writes()
+                    conn.unregister_producer()
                     conn.transport.loseConnection()
             except:
                 logger.error('exc occur. msg: %r', msg, exc_info=True)
 
+    def _handle_ctrl_msg(self, group_id, msg):
+        """
+        处理worker、master发来的控制消息
+        :param msg: dict(ctrl=类型, ...)
+        """
+        ctrl = msg['ctrl']
+
+        if ctrl == 'metrics':
+            self.metrics.merge(msg['metrics'])
+        elif ctrl == 'cache_invalidate':
+            self.invalidate_cache(msg.get('key'), msg.get('prefix'))
+        else:
+            logger.error('invalid ctrl msg. group_id: %r, msg: %r', group_id, msg)
+
+    def render_metrics(self, args=None):
+        """
+        prometheus格式的指标，包括抓取时才计算的队列长度等
+        """
+        gauges = dict()
+        gauges[('melon_connections', ())] = len(self.conn_dict)
+        if self.shm_arena:
+            gauges[('melon_shm_arena_used_bytes', ())] = self.shm_arena.used_bytes()
+        if self.response_cache:
+            gauges[('melon_response_cache_bytes', ())] = self.response_cache.used_bytes
+            gauges[('melon_response_cache_items', ())] = self.response_cache.item_count()
+
+        for group_id in self.group_conf:
+            labels = (('group', group_id),)
+            gauges[('melon_group_queue_depth', labels)] = self.get_group_depth(group_id)
+
+            queues = self.parent_output_dict[group_id]
+            if isinstance(queues[0], LaneQueue):
+                for priority in xrange(len(queues[0].queues)):
+                    gauges[('melon_group_lane_depth', labels + (('lane', priority),))] = sum(
+                        queue.lane_qsize(priority) for queue in queues)
+
+            if self.acceptor_count == 1:
+                gauges[('melon_group_workers', labels)] = self.group_count_dict[group_id]
+
+                # 多acceptor时，各个acceptor只知道自己发出的请求数
+                gauges[('melon_group_inflight', labels)] = max(
+                    self.metrics.get_counter('melon_dispatched_total', labels) -
+                    self.metrics.get_counter('melon_worker_handled_total', labels),
+                    0
+                )
+
+        return self.metrics.render(gauges)
+
+    def start_profile(self, mode=None, duration=None):
+        """
+        统计当前进程的reactor线程，需要在reactor线程中调用
+        :return: 是否成功，已经在统计中时返回False
+        """
+        if not self.profiler.start(mode or self.profile_mode, self.profile_sample_interval,
+                                   thread_label=self.profiler.name):
+            return False
+
+        self.frontend.call_later(duration or self.profile_duration, self.profiler.stop)
+        return True
+
+    def profile_workers(self, group_id, worker_index=None, mode=None, duration=None):
+        """
+        通过信号通知worker开始统计
+        :param worker_index: None 代表group内的所有worker
+        :return: 通知到的pid列表
+        """
+        self._profile_args.value = '%s %s' % (mode or self.profile_mode, duration or self.profile_duration)
+
+        pid_list = []
+        for (pid_group_id, pid_worker_index), pid in self.worker_pid_dict.items():
+            if pid_group_id != group_id or worker_index is not None and pid_worker_index != worker_index:
+                continue
+
+            try:
+                os.kill(pid, self.profile_signal)
+                pid_list.append(pid)
+            except:
+                logger.error('exc occur. pid: %s', pid, exc_info=True)
+
+        return pid_list
+
+    def get_profile_args(self):
+        """
+        worker收到信号时使用的参数，admin没有指定过时使用默认配置
+        :return: (mode, duration)
+        """
+        if self._profile_args.value:
+            mode, duration = self._profile_args.value.split()
+            return mode, float(duration)
+
+        return self.profile_mode, self.profile_duration
+
+    def _admin_profile(self, args):
+        """
+        profile [target] [mode] [duration]
+            target: master(默认)、group:$group_id、worker:$group_id:$worker_index
+            mode: cprofile 或 sample
+        HTTP: /profile?target=group:1&mode=sample&duration=5
+        """
+        params = dict()
+        for i, arg in enumerate(args):
+            if '=' in arg:
+                key, value = arg.split('=', 1)
+                params[key] = value
+            else:
+                params[('target', 'mode', 'duration')[i]] = arg
+
+        mode = params.get('mode') or self.profile_mode
+        duration = float(params.get('duration') or self.profile_duration)
+        target = params.get('target') or 'master'
+
+        if target == 'master':
+            if not self.start_profile(mode, duration):
+                return 'profile already running\n'
+            return 'profile started. pid: %s, dir: %s\n' % (os.getpid(), self.profile_dir)
+
+        parts = target.split(':')
+        group_ids = [group_id for group_id in self.group_conf if str(group_id) == parts[1]] if len(parts) > 1 else []
+        if parts[0] not in ('group', 'worker') or not group_ids:
+            raise ValueError('invalid target: %s' % target)
+
+        if not self.worker_pid_dict:
+            raise ValueError('worker pids are only known by master, send %s to the worker directly' %
+                             self.profile_signal)
+
+        worker_index = int(parts[2]) if parts[0] == 'worker' else None
+        pid_list = self.profile_workers(group_ids[0], worker_index, mode, duration)
+
+        return 'profile started. pids: %s, dir: %s\n' % (pid_list, self.profile_dir)
+
+    def _admin_reload(self, args):
+        """
+        reload: 平滑重启所有worker
+        """
+        if os.getpid() == self._master_pid:
+            self.request_reload()
+        else:
+            os.kill(self._master_pid, self.reload_signal)
+
+        return 'reload requested. master: %s\n' % self._master_pid
+
+    def _admin_cache_invalidate(self, args):
+        """
+        cache_invalidate [key $key | prefix $prefix]，不传参数时清空
+        多acceptor时只删除当前acceptor的缓存
+        """
+        if not self.response_cache:
+            return 'response cache disabled\n'
+
+        if not args:
+            count = self.invalidate_cache()
+        elif len(args) == 2 and args[0] in ('key', 'prefix'):
+            count = self.invalidate_cache(**{args[0]: args[1]})
+        else:
+            raise ValueError('usage: cache_invalidate [key $key | prefix $prefix]')
+
+        return 'invalidated: %s\n' % count
+
     def _handle_parent_proc_signals(self):
         def custom_signal_handler(signum, frame):
             """
             在centos6下，callFromThread(stop)无效，因为处理不够及时
             """
+            self._stopping = True
             try:
-                reactor.stop()
+                self.frontend.stop()
             except:
                 pass
 
         signal.signal(signal.SIGTERM, custom_signal_handler)
         signal.signal(signal.SIGINT, custom_signal_handler)
+        signal.signal(self.profile_signal, lambda signum, frame: safe_call(self.start_profile))
+
+    def _handle_master_signals(self):
+        """
+        多acceptor时master不运行网络层，收到信号后退出管理循环，由multiprocessing结束所有子进程
+        """
+        def custom_signal_handler(signum, frame):
+            self._stopping = True
+            raise KeyboardInterrupt
+
+        signal.signal(signal.SIGTERM, custom_signal_handler)
+        signal.signal(signal.SIGINT, custom_signal_handler)
+        # master中没有请求可以统计
+        signal.signal(self.profile_signal, signal.SIG_IGN)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+进程内的指标统计
+
+worker在本地累计counter和固定分桶的histogram，定期把增量发给master
+master汇总之后通过admin端口输出为prometheus的文本格式
+
+labels 统一使用 ((key, value), ...) 形式的tuple，可以直接作为dict的key
+"""
+
+import bisect
+from threading import Lock
+
+
+# histogram 的分桶上限(秒)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metrics(object):
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # {(name, labels): value}
+        self.counters = dict()
+        # {(name, labels): [bucket_0, ..., bucket_n, +Inf, sum]}，每个桶是不累计的数量
+        self.histograms = dict()
+        # worker开启 concurrency 时会在多个线程中记录
+        self._lock = Lock()
+
+    def incr(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(self.buckets) + 2)
+
+            hist[bisect.bisect_left(self.buckets, value)] += 1
+            hist[-1] += value
+
+    def pop_snapshot(self):
+        """
+        取出当前的统计并清零
+        :return: 没有数据时返回None
+        """
+        with self._lock:
+            if not self.counters and not self.histograms:
+                return None
+
+            snapshot = dict(
+                counters=self.counters,
+                histograms=self.histograms,
+            )
+            self.counters = dict()
+            self.histograms = dict()
+
+        return snapshot
+
+    def merge(self, snapshot):
+        """
+        合并其他进程发过来的统计
+        """
+        with self._lock:
+            for key, value in snapshot['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+            for key, other in snapshot['histograms'].items():
+                hist = self.histograms.get(key)
+                if hist is None:
+                    self.histograms[key] = list(other)
+                elif len(hist) == len(other):
+                    for i, value in enumerate(other):
+                        hist[i] += value
+
+    def get_counter(self, name, labels=()):
+        return self.counters.get((name, labels), 0)
+
+    def render(self, gauges=None):
+        """
+        输出为prometheus的文本格式
+        :param gauges: 抓取时才计算的值 {(name, labels): value}
+        :return: str
+        """
+        lines = []
+
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(hist)) for key, hist in self.histograms.items())
+
+        _render_samples(lines, 'counter', counters)
+        _render_samples(lines, 'gauge', sorted((gauges or dict()).items()))
+
+        last_name = None
+        for (name, labels), hist in histograms:
+            if name != last_name:
+                lines.append('# TYPE %s histogram' % name)
+                last_name = name
+
+            total = 0
+            for upper, count in zip(self.buckets + ('+Inf',), hist[:-1]):
+                total += count
+                lines.append('%s_bucket%s %s' % (name, _format_labels(labels + (('le', upper),)), total))
+            lines.append('%s_sum%s %r' % (name, _format_labels(labels), float(hist[-1])))
+            lines.append('%s_count%s %s' % (name, _format_labels(labels), total))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _render_samples(lines, metric_type, samples):
+    last_name = None
+    for (name, labels), value in samples:
+        if name != last_name:
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            last_name = name
+        lines.append('%s%s %s' % (name, _format_labels(labels), value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (key, _escape_label_value(value)) for key, value in labels)
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
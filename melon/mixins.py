@@ -16,8 +16,17 @@ class RoutesMixin(object):
     def __init__(self):
         self.rule_map = dict()
 
-    def add_route_rule(self, cmd, view_func, endpoint=None):
-        if cmd in self.rule_map and view_func != self.rule_map[cmd]['view_func']:
+    def add_route_rule(self, cmd, view_func, endpoint=None, deadline=None, priority=None,
+                       cache_ttl=None, cache_key=None):
+        """
+        :param deadline: 覆盖group_conf中的deadline，0代表不限制
+        :param priority: 开启了priorities的group中的优先级，0最高，不传则使用group的default_priority
+        :param cache_ttl: 大于0时master缓存这个cmd的返回(ret为0)，秒数，见 response_cache.py
+        :param cache_key: 缓存的key，func(box)返回str，返回None代表不使用缓存，不传则使用 box.body
+        """
+        # 平滑重启时重新加载模块，同名函数会再注册一次
+        if cmd in self.rule_map and view_func != self.rule_map[cmd]['view_func'] and \
+                not _is_same_func(view_func, self.rule_map[cmd]['view_func']):
             raise Exception(
                 'duplicate view_func for cmd: %(cmd)s, old_view_func: %(old_view_func)s, new_view_func: %(new_view_func)s' % dict(
                     cmd=cmd,
@@ -29,11 +38,15 @@ class RoutesMixin(object):
         self.rule_map[cmd] = dict(
             endpoint=endpoint or view_func.__name__,
             view_func=view_func,
+            deadline=deadline,
+            priority=priority,
+            cache_ttl=cache_ttl,
+            cache_key=cache_key,
         )
 
-    def route(self, cmd, endpoint=None):
+    def route(self, cmd, endpoint=None, deadline=None, priority=None, cache_ttl=None, cache_key=None):
         def decorator(func):
-            self.add_route_rule(cmd, func, endpoint)
+            self.add_route_rule(cmd, func, endpoint, deadline, priority, cache_ttl, cache_key)
             return func
         return decorator
 
@@ -41,6 +54,11 @@ class RoutesMixin(object):
         return self.rule_map.get(cmd)
 
 
+def _is_same_func(func, other):
+    return (getattr(func, '__module__', None), getattr(func, '__name__', None)) == \
+        (getattr(other, '__module__', None), getattr(other, '__name__', None))
+
+
 def _reg_event_handler(func):
     @functools.wraps(func)
     def func_wrapper(obj, handler):
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+运行时开启的性能分析
+
+cprofile:   使用cProfile，每个endpoint输出一个pstats文件，可以用 pstats/snakeviz 等工具查看
+sample:     定时采样线程的调用栈，输出为 collapsed stacks 格式(每行 endpoint;frame;frame... count)，可以直接用 flamegraph.pl 生成火焰图
+
+worker按请求统计，栈的第一层为请求的endpoint
+master没有请求，统计整个reactor线程，label固定
+"""
+
+import os
+import sys
+import time
+import cProfile
+import pstats
+from collections import Counter
+from threading import Thread, Condition, current_thread
+
+from .log import logger
+
+
+PROFILE_MODES = ('cprofile', 'sample')
+
+
+class Profiler(object):
+
+    def __init__(self, name, output_dir):
+        """
+        :param name: 输出文件名中使用，如 worker-1-0
+        :param output_dir: 输出目录
+        """
+        self.name = name
+        self.output_dir = output_dir
+
+        self.active = False
+        self.mode = None
+        self.sample_interval = None
+        self.begin_time = None
+
+        # {(thread_id, label): cProfile.Profile}
+        self._profiles = dict()
+        # 采样时每个线程当前的label {thread_id: label}
+        self._thread_labels = dict()
+        # {collapsed stack: count}
+        self._stacks = Counter()
+        # 正在统计中的请求数，stop时要等这些请求结束
+        self._running = 0
+        self._cond = Condition()
+        # 统计整个线程时使用
+        self._thread_profile = None
+        self._sample_thread = None
+
+    def start(self, mode, sample_interval=0.005, thread_label=None):
+        """
+        开始统计
+        :param mode: cprofile 或 sample
+        :param sample_interval: 采样间隔(秒)
+        :param thread_label: 不为None时统计调用线程的全部执行，而不是按请求统计
+        :return: 是否成功，已经在统计中时返回False
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError('invalid profile mode: %r' % mode)
+
+        with self._cond:
+            if self.active:
+                return False
+
+            self.active = True
+            self.mode = mode
+            self.sample_interval = sample_interval
+            self.begin_time = time.time()
+            self._profiles = dict()
+            self._thread_labels = dict()
+            self._stacks = Counter()
+
+            if thread_label is not None:
+                if mode == 'cprofile':
+                    self._thread_profile = cProfile.Profile()
+                    self._profiles[(current_thread().ident, thread_label)] = self._thread_profile
+                else:
+                    self._thread_labels[current_thread().ident] = thread_label
+
+        if mode == 'sample':
+            self._sample_thread = Thread(target=self._sample_loop)
+            self._sample_thread.daemon = True
+            self._sample_thread.start()
+
+        if self._thread_profile:
+            self._thread_profile.enable()
+
+        logger.error('profile start. name: %s, mode: %s', self.name, mode)
+        return True
+
+    def begin_request(self, label):
+        """
+        请求开始处理
+        :return: 需要传给 end_request，没有在统计时返回None
+        """
+        thread_id = current_thread().ident
+
+        with self._cond:
+            if not self.active:
+                return None
+
+            self._running += 1
+
+            if self.mode == 'cprofile':
+                key = (thread_id, label)
+                profile = self._profiles.get(key)
+                if profile is None:
+                    profile = self._profiles[key] = cProfile.Profile()
+            else:
+                profile = None
+                self._thread_labels[thread_id] = label
+
+        if profile is not None:
+            profile.enable()
+
+        return profile or thread_id
+
+    def end_request(self, token):
+        if isinstance(token, cProfile.Profile):
+            token.disable()
+        else:
+            self._thread_labels.pop(token, None)
+
+        with self._cond:
+            self._running -= 1
+            self._cond.notify_all()
+
+    def stop(self):
+        """
+        结束统计并输出到文件
+        按线程统计的cprofile，需要在调用start的线程中调用
+        :return: 输出的文件列表
+        """
+        with self._cond:
+            if not self.active:
+                return []
+
+            self.active = False
+            while self._running > 0:
+                self._cond.wait()
+
+        if self._thread_profile:
+            self._thread_profile.disable()
+            self._thread_profile = None
+
+        if self._sample_thread:
+            self._sample_thread.join()
+            self._sample_thread = None
+
+        try:
+            if self.mode == 'cprofile':
+                files = self._dump_pstats()
+            else:
+                files = self._dump_collapsed()
+        except:
+            logger.error('exc occur. name: %s', self.name, exc_info=True)
+            return []
+
+        logger.error('profile stop. name: %s, mode: %s, files: %s', self.name, self.mode, files)
+        return files
+
+    def _make_path(self, label, ext):
+        filename = 'melon-%s-%s-%s' % (
+            self.name, os.getpid(), time.strftime('%Y%m%d%H%M%S', time.localtime(self.begin_time))
+        )
+        if label is not None:
+            filename += '.' + ''.join(c if c.isalnum() or c in '-_.' else '_' for c in str(label))
+
+        return os.path.join(self.output_dir, filename + ext)
+
+    def _dump_pstats(self):
+        label_stats = dict()
+        for (thread_id, label), profile in self._profiles.items():
+            profile.create_stats()
+            if not profile.stats:
+                continue
+
+            if label in label_stats:
+                label_stats[label].add(profile)
+            else:
+                label_stats[label] = pstats.Stats(profile)
+
+        files = []
+        for label, stats in label_stats.items():
+            path = self._make_path(label, '.prof')
+            stats.dump_stats(path)
+            files.append(path)
+
+        return files
+
+    def _dump_collapsed(self):
+        path = self._make_path(None, '.collapsed')
+        with open(path, 'w') as f:
+            for stack, count in sorted(self._stacks.items()):
+                f.write('%s %s\n' % (stack, count))
+
+        return [path]
+
+    def _sample_loop(self):
+        while self.active:
+            frames = sys._current_frames()
+
+            for thread_id, label in self._thread_labels.items():
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%s)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+
+                stack.append(str(label))
+                self._stacks[';'.join(reversed(stack))] += 1
+
+            time.sleep(self.sample_interval)
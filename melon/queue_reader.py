@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+把worker返回的队列直接注册到reactor(或者asyncio的loop)上，不再需要轮询线程 + callFromThread
+"""
+
+from Queue import Empty
+
+from zope.interface import implementer
+from twisted.internet.interfaces import IReadDescriptor
+
+from .log import logger
+
+
+def get_queue_fileno(queue):
+    """
+    获取队列可读时对应的fd
+    ShmQueue 提供了 fileno，multiprocessing.Queue 使用内部pipe的读端
+    """
+    if hasattr(queue, 'fileno'):
+        return queue.fileno()
+
+    return queue._reader.fileno()
+
+
+def drain_queue(queue, max_count):
+    """
+    非阻塞地从队列里取出已有的msg
+    worker批量返回的msg会被拆开
+    :param queue:
+    :param max_count: 最多取出的数量
+    :return: msg list
+    """
+    items = []
+    while len(items) < max_count:
+        try:
+            items.append(queue.get_nowait())
+        except Empty:
+            break
+
+    return flatten_msg_list(items)
+
+
+def flatten_msg_list(items):
+    msg_list = []
+    for item in items:
+        if isinstance(item, list):
+            msg_list.extend(item)
+        else:
+            msg_list.append(item)
+    return msg_list
+
+
+@implementer(IReadDescriptor)
+class QueueReader(object):
+    """
+    队列的读端，队列中有数据时由reactor调用doRead
+    队列只能有这一个读者
+    """
+
+    def __init__(self, frontend, queue, callback, max_batch):
+        """
+        :param frontend: master的网络层
+        :param queue: 队列
+        :param callback: callback(msg_list)
+        :param max_batch: 每次doRead最多处理的msg数量，避免阻塞reactor太久
+        """
+        self.frontend = frontend
+        self.queue = queue
+        self.callback = callback
+        self.max_batch = max_batch
+        self._fileno = get_queue_fileno(queue)
+
+    def startReading(self):
+        self.frontend.add_reader(self)
+        # ShmQueue 需要先 drain 一次才会在有数据时唤醒
+        self.frontend.call_later(0, self.doRead)
+
+    def fileno(self):
+        return self._fileno
+
+    def doRead(self):
+        try:
+            if hasattr(self.queue, 'drain'):
+                msg_list = flatten_msg_list(self.queue.drain(self.max_batch))
+            else:
+                msg_list = drain_queue(self.queue, self.max_batch)
+        except:
+            logger.error('exc occur.', exc_info=True)
+            return
+
+        if len(msg_list) >= self.max_batch:
+            # 可能还有没取完的数据，fd不一定还是可读的，所以主动再来一次
+            self.frontend.call_later(0, self.doRead)
+
+        if msg_list:
+            self.callback(msg_list)
+
+    def connectionLost(self, reason):
+        pass
+
+    def logPrefix(self):
+        return self.__class__.__name__
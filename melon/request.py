@@ -3,6 +3,7 @@
 import os
 import numbers
 from .log import logger
+from .utils import restore_box
 
 
 class Request(object):
@@ -16,8 +17,12 @@ class Request(object):
     is_valid = False
     blueprint = None
     route_rule = None
+    # app.route_table 中的项
+    route_entry = None
     # 是否中断处理，即不调用view_func，主要用在before_request中
     interrupted = False
+    # 返回是否已经写入master的缓存，只缓存第一个返回
+    _cache_written = False
 
     def __init__(self, worker, msg):
         self.worker = worker
@@ -31,7 +36,16 @@ class Request(object):
             logger.error('create box fail. e: %s, request: %s', e, self)
             return False
 
-        if self.box.unpack(self.msg.get('data') or '') > 0:
+        data = self.msg.get('data') or ''
+        header = self.msg.get('header')
+
+        if header is not None:
+            # master已经解析过包头，不需要再解析一次
+            ret = restore_box(self.box, header, data)
+        else:
+            ret = self.box.unpack(data)
+
+        if ret > 0:
             self._parse_route_rule()
             return True
         else:
@@ -42,18 +56,14 @@ class Request(object):
         if self.cmd is None:
             return
 
-        route_rule = self.app.get_route_rule(self.cmd)
-        if route_rule:
-            # 在app层，直接返回
-            self.route_rule = route_rule
-            return
+        if self.app.route_table is None:
+            self.app.build_dispatch_tables()
 
-        for bp in self.app.blueprints:
-            route_rule = bp.get_route_rule(self.cmd)
-            if route_rule:
-                self.blueprint = bp
-                self.route_rule = route_rule
-                break
+        route_entry = self.app.route_table.get(self.cmd)
+        if route_entry:
+            self.route_entry = route_entry
+            self.blueprint = route_entry['blueprint']
+            self.route_rule = route_entry['route_rule']
 
     @property
     def app(self):
@@ -63,6 +73,23 @@ class Request(object):
     def address(self):
         return self.msg.get('address')
 
+    @property
+    def recv_time(self):
+        """
+        master收到请求的时间
+        """
+        return self.msg.get('recv_time')
+
+    @property
+    def deadline(self):
+        """
+        请求在队列中等待的最长时间，route上的配置优先，0代表不限制
+        """
+        if self.route_rule and self.route_rule.get('deadline') is not None:
+            return self.route_rule['deadline']
+
+        return self.worker.deadline
+
     @property
     def cmd(self):
         try:
@@ -88,7 +115,9 @@ class Request(object):
             # 生成box
             data = self.box.map(data)
 
+        cache_info = None
         if isinstance(data, self.worker.app.box_class):
+            cache_info = self._get_cache_info(data)
             data = data.pack()
 
         msg = dict(
@@ -96,9 +125,32 @@ class Request(object):
             data=data,
             pid=os.getpid(),
         )
+        if cache_info:
+            msg['cache'] = cache_info
 
         return self.worker.write(msg)
 
+    def _get_cache_info(self, box):
+        """
+        master需要缓存这个返回时，返回 (key, epoch, ttl)
+        """
+        if self._cache_written or 'cache' not in self.msg or box.ret != 0:
+            return None
+
+        ttl = self.route_rule and self.route_rule.get('cache_ttl')
+        if not ttl:
+            return None
+
+        self._cache_written = True
+        cache_key, epoch = self.msg['cache']
+        return cache_key, epoch, ttl
+
+    def invalidate_cache(self, key=None, prefix=None):
+        """
+        删除master中的返回缓存，key的格式为 "cmd:key"，key和prefix都不传时清空
+        """
+        return self.worker.invalidate_cache(key, prefix)
+
     def close(self, exc_info=False):
         return self.write(None)
 
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+master中的返回缓存，给只读的cmd使用
+
+route上设置了 cache_ttl 的cmd，master收到请求后先按key查找缓存，命中时直接返回，不再发给worker
+没有命中时请求带上key发给worker，worker返回 ret 为0 的结果时写入缓存
+
+key的格式为 "cmd:key_func(box)"，key_func 默认为 box.body
+worker调用 request.invalidate_cache 或 admin执行 cache_invalidate 时按key或前缀删除
+多acceptor时每个acceptor一份缓存
+"""
+
+import time
+from collections import OrderedDict
+
+
+class ResponseCache(object):
+
+    def __init__(self, max_bytes):
+        """
+        :param max_bytes: 缓存的总字节数上限，超过时淘汰最久没有使用的
+        """
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        # {key: (过期时间, 字节数, value)}，按使用顺序排列，最近使用的在最后
+        self._item_dict = OrderedDict()
+        # 每次删除加1，发给worker之前记录，返回时不一致说明期间有过删除，结果可能已经过期，不写入缓存
+        self.epoch = 0
+
+    def get(self, key, now=None):
+        """
+        :return: value，没有或者已经过期时返回None
+        """
+        item = self._item_dict.pop(key, None)
+        if item is None:
+            return None
+
+        if item[0] <= (now or time.time()):
+            self.used_bytes -= item[1]
+            return None
+
+        # 重新放到最后
+        self._item_dict[key] = item
+        return item[2]
+
+    def set(self, key, value, size, ttl):
+        """
+        :param size: value的字节数
+        :param ttl: 过期秒数
+        :return: 是否写入
+        """
+        if size > self.max_bytes:
+            return False
+
+        self._pop(key)
+
+        while self._item_dict and self.used_bytes + size > self.max_bytes:
+            self._pop(next(iter(self._item_dict)))
+
+        self._item_dict[key] = (time.time() + ttl, size, value)
+        self.used_bytes += size
+        return True
+
+    def invalidate(self, key=None, prefix=None):
+        """
+        key和prefix都不传时清空
+        :return: 删除的数量
+        """
+        self.epoch += 1
+
+        if key is not None:
+            return 1 if self._pop(key) else 0
+
+        if prefix is None:
+            count = len(self._item_dict)
+            self._item_dict.clear()
+            self.used_bytes = 0
+            return count
+
+        keys = [it for it in self._item_dict if it.startswith(prefix)]
+        for it in keys:
+            self._pop(it)
+
+        return len(keys)
+
+    def item_count(self):
+        return len(self._item_dict)
+
+    def _pop(self, key):
+        item = self._item_dict.pop(key, None)
+        if item is None:
+            return False
+
+        self.used_bytes -= item[1]
+        return True
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+master与worker之间传输大数据时使用的共享内存
+
+msg中的data超过 Melon.shm_payload_threshold 时，data写入共享内存，msg中只带上位置 msg['shm'] = (page, length)
+接收方读取之后释放引用，引用计数为0时回收
+共享内存不足时返回None，调用方继续使用原来的方式传输
+
+按页分配，每次分配连续的若干页，从上次分配的位置之后开始查找(next fit)
+和 ShmQueue 一样，必须在fork之前创建
+"""
+
+import mmap
+from multiprocessing import Lock
+from multiprocessing.sharedctypes import RawArray, RawValue
+
+from . import envelope
+
+
+class ShmArena(object):
+
+    page_size = 64 * 1024
+
+    def __init__(self, size, page_size=None):
+        """
+        :param size: 共享内存大小，按页向下取整
+        :param page_size: 页大小
+        """
+        if page_size is not None:
+            self.page_size = page_size
+
+        self.page_count = max(size // self.page_size, 1)
+        self._mem = mmap.mmap(-1, self.page_count * self.page_size)
+        # 每次分配的第一页记录引用计数，0代表空闲，后续页记录为-1
+        self._refs = RawArray('i', self.page_count)
+        # 每次分配的第一页记录占用的页数
+        self._runs = RawArray('i', self.page_count)
+        self._cursor = RawValue('i', 0)
+        self._used_pages = RawValue('i', 0)
+        self._lock = Lock()
+
+    def put(self, data, refs=1):
+        """
+        写入数据
+        :param data: str 或 buffer
+        :param refs: 初始的引用计数，即需要读取的次数
+        :return: 位置 (page, length)，空间不足时返回None
+        """
+        length = len(data)
+        pages = max((length + self.page_size - 1) // self.page_size, 1)
+
+        with self._lock:
+            page = self._find_free_pages(pages)
+            if page is None:
+                return None
+
+            self._refs[page] = refs
+            for it in xrange(page + 1, page + pages):
+                self._refs[it] = -1
+            self._runs[page] = pages
+            self._cursor.value = (page + pages) % self.page_count
+            self._used_pages.value += pages
+
+        # 这段内存已经属于当前进程，不需要加锁
+        offset = page * self.page_size
+        self._mem[offset:offset + length] = data
+
+        return page, length
+
+    def get(self, handle, release=True):
+        """
+        读取数据
+        :param handle: put 返回的位置
+        :param release: 读取之后是否释放引用
+        :return: str
+        """
+        page, length = handle
+        offset = page * self.page_size
+        data = self._mem[offset:offset + length]
+
+        if release:
+            self.release(handle)
+
+        return data
+
+    def retain(self, handle):
+        with self._lock:
+            self._refs[handle[0]] += 1
+
+    def release(self, handle):
+        page = handle[0]
+
+        with self._lock:
+            if self._refs[page] <= 0:
+                return
+
+            self._refs[page] -= 1
+            if self._refs[page] > 0:
+                return
+
+            pages = self._runs[page]
+            for it in xrange(page, page + pages):
+                self._refs[it] = 0
+            self._runs[page] = 0
+            self._used_pages.value -= pages
+
+    def used_bytes(self):
+        return self._used_pages.value * self.page_size
+
+    def _find_free_pages(self, pages):
+        """
+        查找连续的空闲页，需要在锁中调用
+        :return: 第一页，没有时返回None
+        """
+        if pages > self.page_count - self._used_pages.value:
+            return None
+
+        page = self._cursor.value
+        if page + pages > self.page_count:
+            page = 0
+        # 从cursor查到末尾，再从头查一遍
+        wrapped = False
+
+        while 1:
+            if page + pages > self.page_count:
+                if wrapped:
+                    return None
+                wrapped = True
+                page = 0
+
+            for it in xrange(page, page + pages):
+                if self._refs[it] != 0:
+                    # 跳过这次分配占用的页
+                    page = it + max(self._runs[it], 1)
+                    break
+            else:
+                return page
+
+            if wrapped and page >= self._cursor.value:
+                return None
+
+
+def release_msgs(arena, items):
+    """
+    msg没有发送成功时，释放其中的共享内存
+    :param items: msg、envelope打包后的str，或者它们的list
+    """
+    if not isinstance(items, list):
+        items = [items]
+
+    for item in items:
+        if isinstance(item, str):
+            item = envelope.unpack(item)
+        if isinstance(item, dict) and 'shm' in item:
+            arena.release(item['shm'])
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+基于共享内存(mmap)的环形队列，可以替代 multiprocessing.Queue 作为 master 与 worker 之间的传输
+
+与 multiprocessing.Queue 的区别:
+1. put_nowait 直接写入共享内存，没有feeder线程，也不需要写pipe
+2. 只有在有读者阻塞等待时，才会通过pipe唤醒，所以大部分情况下没有系统调用
+3. str 类型(比如 compact_msg 模式下 envelope 打包后的msg)直接写入，不再pickle
+4. 必须在fork之前创建，父子进程共享同一块内存
+"""
+
+import os
+import errno
+import fcntl
+import mmap
+import struct
+import select
+import time
+import cPickle as pickle
+from Queue import Empty, Full
+from multiprocessing import Lock
+
+
+class ShmQueue(object):
+    """
+    多生产者多消费者的环形队列
+    共享内存的头部记录读写位置，之后是数据区，每条msg为 4字节长度 + pickle之后的数据(str类型则为原始数据)
+    """
+
+    # 数据区大小
+    buffer_size = 16 * 1024 * 1024
+
+    # head: 已读位置，tail: 已写位置，都是单调递增的
+    # count: 当前msg数量，waiters: 正在等待唤醒的读者数量
+    header_fmt = '=QQII'
+    header_len = struct.calcsize(header_fmt)
+
+    length_fmt = '=I'
+    length_len = struct.calcsize(length_fmt)
+    # 长度的最高位代表数据是原始的str，没有经过pickle，比如 envelope 打包后的msg
+    raw_flag = 1 << 31
+
+    def __init__(self, maxsize=0, buffer_size=None):
+        """
+        :param maxsize: 最大msg数量，0代表只受 buffer_size 限制
+        :param buffer_size: 数据区大小
+        """
+        self.maxsize = maxsize
+        if buffer_size is not None:
+            self.buffer_size = buffer_size
+
+        self._mem = mmap.mmap(-1, self.header_len + self.buffer_size)
+        self._lock = Lock()
+        self._wakeup_reader, self._wakeup_writer = os.pipe()
+        # drain 模式下，当前进程是否已经登记为等待者
+        self._drain_waiting = False
+
+        # 读端非阻塞，多个读者同时被唤醒时，没有抢到的继续等待
+        flags = fcntl.fcntl(self._wakeup_reader, fcntl.F_GETFL)
+        fcntl.fcntl(self._wakeup_reader, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def put_nowait(self, obj):
+        """
+        写入，空间不足时抛出 Queue.Full
+        """
+        if type(obj) is str:
+            data = obj
+            length = len(data) | self.raw_flag
+        else:
+            data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+            length = len(data)
+        size = self.length_len + len(data)
+
+        if size > self.buffer_size:
+            raise Full
+
+        with self._lock:
+            head, tail, count, waiters = self._read_header()
+
+            if self.maxsize > 0 and count >= self.maxsize:
+                raise Full
+            if tail - head + size > self.buffer_size:
+                raise Full
+
+            self._write_data(tail, struct.pack(self.length_fmt, length))
+            self._write_data(tail + self.length_len, data)
+
+            if waiters > 0:
+                # 每个字节唤醒一个读者
+                waiters -= 1
+                os.write(self._wakeup_writer, 'x')
+
+            self._write_header(head, tail + size, count + 1, waiters)
+
+    def get(self, block=True, timeout=None):
+        """
+        读取，队列为空时阻塞等待，超时或者非阻塞时抛出 Queue.Empty
+        """
+        deadline = time.time() + timeout if block and timeout is not None else None
+
+        while 1:
+            with self._lock:
+                item = self._pop_data()
+                if item is None and block:
+                    self._add_waiters(1)
+
+            if item is not None:
+                # 反序列化放到锁外面
+                raw, data = item
+                return data if raw else pickle.loads(data)
+
+            if not block:
+                raise Empty
+
+            remaining = max(deadline - time.time(), 0) if deadline is not None else None
+            if not self._wait_wakeup(remaining):
+                raise Empty
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def fileno(self):
+        """
+        配合 drain 使用，可读时代表队列中有新数据
+        """
+        return self._wakeup_reader
+
+    def drain(self, max_count):
+        """
+        非阻塞地取出最多 max_count 条msg，给注册到reactor上的唯一读者使用
+        取空之后会登记为等待者，之后有数据写入时 fileno 会变为可读
+        :param max_count:
+        :return: list
+        """
+        if self._drain_waiting and self._read_wakeup():
+            self._drain_waiting = False
+
+        items = []
+        with self._lock:
+            while len(items) < max_count:
+                item = self._pop_data()
+                if item is None:
+                    break
+                items.append(item)
+
+            if len(items) < max_count and not self._drain_waiting:
+                self._add_waiters(1)
+                self._drain_waiting = True
+
+        return [data if raw else pickle.loads(data) for raw, data in items]
+
+    def qsize(self):
+        return self._read_header()[2]
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        return 0 < self.maxsize <= self.qsize()
+
+    def _wait_wakeup(self, timeout):
+        """
+        等待写者唤醒
+        :return: 是否被唤醒，False代表超时
+        """
+        while 1:
+            try:
+                rlist = select.select([self._wakeup_reader], [], [], timeout)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if not rlist:
+                with self._lock:
+                    # 超时的同时可能刚好被唤醒，这时候要把唤醒的字节读掉，否则要自己把等待数减掉
+                    if not self._read_wakeup():
+                        self._add_waiters(-1)
+                return False
+
+            if self._read_wakeup():
+                return True
+
+    def _read_wakeup(self):
+        try:
+            return bool(os.read(self._wakeup_reader, 1))
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return False
+            raise
+
+    def _pop_data(self):
+        """
+        需要在锁内调用
+        :return: (raw, data)，没有数据时返回None
+        """
+        head, tail, count, waiters = self._read_header()
+        if not count:
+            return None
+
+        length = struct.unpack(self.length_fmt, self._read_data(head, self.length_len))[0]
+        raw = length & self.raw_flag
+        length &= ~self.raw_flag
+
+        data = self._read_data(head + self.length_len, length)
+
+        self._write_header(head + self.length_len + length, tail, count - 1, waiters)
+
+        return raw, data
+
+    def _add_waiters(self, delta):
+        head, tail, count, waiters = self._read_header()
+        self._write_header(head, tail, count, waiters + delta)
+
+    def _read_header(self):
+        return struct.unpack_from(self.header_fmt, self._mem, 0)
+
+    def _write_header(self, head, tail, count, waiters):
+        struct.pack_into(self.header_fmt, self._mem, 0, head, tail, count, waiters)
+
+    def _write_data(self, pos, data):
+        """
+        写入数据区，超出结尾的部分从头开始写
+        """
+        offset = pos % self.buffer_size
+        first = min(len(data), self.buffer_size - offset)
+
+        begin = self.header_len + offset
+        self._mem[begin:begin + first] = data[:first]
+        if first < len(data):
+            self._mem[self.header_len:self.header_len + len(data) - first] = data[first:]
+
+    def _read_data(self, pos, length):
+        offset = pos % self.buffer_size
+        first = min(length, self.buffer_size - offset)
+
+        begin = self.header_len + offset
+        data = self._mem[begin:begin + first]
+        if first < length:
+            data += self._mem[self.header_len:self.header_len + length - first]
+        return data
+
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import functools
+import struct
+import socket
+from . import constants
 from .log import logger
 
 
@@ -24,3 +27,100 @@ def safe_func(func):
     def func_wrapper(*args, **kwargs):
         return safe_call(func, *args, **kwargs)
     return func_wrapper
+
+
+def peek_box_header(box, buf):
+    """
+    只解析box的包头，不拷贝包体
+    box_class 需要和 netkit.box.Box 一样提供 header_attrs、header_fmt
+    :param box: box对象，只有包头字段会被赋值
+    :param buf: 输入buf
+    :return: (ret, header)
+        ret: 与 box.unpack 的返回值含义一致
+        header: 包头字段值的tuple，ret <= 0 时为None
+    """
+    # 和 box.unpack 的检查一致，但包头只解析一次
+    if len(buf) < box.header_len:
+        return 0, None
+
+    try:
+        header = struct.unpack_from(box.header_fmt, buf)
+    except Exception, e:
+        logger.error('unpack fail.', exc_info=True)
+        return -1, None
+
+    dict_values = dict(zip(box.header_attrs, header))
+
+    if not box.verify_header(dict_values):
+        return -2, None
+
+    if 'packet_len' in dict_values:
+        packet_len = dict_values['packet_len']
+    elif 'body_len' in dict_values:
+        packet_len = dict_values['body_len'] + box.header_len
+    else:
+        logger.error('there is no packet_len or body_len in header')
+        return -3, None
+
+    if packet_len < box.header_len:
+        return -4, None
+
+    if len(buf) < packet_len:
+        return 0, None
+
+    for k, v in dict_values.iteritems():
+        setattr(box, k, v)
+
+    return packet_len, header
+
+
+def restore_box(box, header, data):
+    """
+    用 peek_box_header 得到的包头和原始数据还原box，不再重复解析包头
+    :param box: box对象
+    :param header: 包头字段值的tuple
+    :param data: 完整的原始数据
+    :return: 与 box.unpack 的返回值含义一致
+    """
+    for k, v in zip(box.header_attrs, header):
+        setattr(box, k, v)
+
+    box.body = data[box.header_len:]
+    box.unpack_done = True
+
+    return len(data)
+
+
+def get_acceptor_index(conn_id):
+    """
+    conn_id 所属的acceptor
+    """
+    return (conn_id >> constants.CONN_ID_SEQ_BITS) & ((1 << constants.CONN_ID_ACCEPTOR_BITS) - 1)
+
+
+def get_group_counts(conf):
+    """
+    group的worker数配置
+    :return: (初始数量, 最少数量, 最多数量)
+    """
+    min_count = conf.get('min_count') or conf.get('count', 1)
+    count = max(conf.get('count') or min_count, min_count)
+    max_count = max(conf.get('max_count') or count, count)
+
+    return count, min_count, max_count
+
+
+def create_reuse_port_socket(host, port, backlog):
+    """
+    创建开启了 SO_REUSEPORT 的监听socket，多个acceptor进程可以监听同一个端口，由内核分配连接
+    """
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+
+    return sock
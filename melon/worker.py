@@ -1,9 +1,22 @@
 # -*- coding: utf-8 -*-
 
+import os
+import sys
+import time
 import signal
+import importlib
+from collections import deque
+from multiprocessing import Event
+from multiprocessing import Lock as ProcessLock
+from threading import Thread, Lock, Timer
 import setproctitle
 from . import constants
+from . import envelope
 from .log import logger
+from .utils import get_acceptor_index, safe_func
+from .metrics import Metrics
+from .profiler import Profiler
+from .shm_arena import release_msgs
 
 
 class Worker(object):
@@ -11,29 +24,123 @@ class Worker(object):
     group_id = None
     child_input = None
     child_output = None
+    # 在group内的序号
+    worker_index = None
+    # 已经处理完的请求数量，按acceptor分别统计
+    handled_list = None
 
-    def __init__(self, app, group_id, child_input, child_output):
+    # 批量传输的配置，见 group_conf
+    batch_max_msgs = 0
+    batch_max_delay_ms = 0
+    # 同时处理的请求数，大于1时使用多个线程处理
+    concurrency = 1
+    # 第几次平滑重启时启动的
+    generation = 0
+    # 请求在队列中等待的最长时间(秒)，见 group_conf
+    deadline = 0
+
+    def __init__(self, app, group_id, child_input, child_output, worker_index=0, generation=0, slot=None):
         """
 
         :param app: melon app
         :param group_id: group_id
         :param child_input: 读取数据
-        :param child_output: 写入数据
+        :param child_output: 写入数据，每个acceptor一个队列
+        :param worker_index: 在group内的序号
+        :param generation: 第几次平滑重启时启动的
+        :param slot: 自动伸缩、watchdog使用的统计的位置，由master分配，不传则使用worker_index
         :return:
         """
         self.app = app
         self.group_id = group_id
         self.child_input = child_input
         self.child_output = child_output
+        self.worker_index = worker_index
+        self.generation = generation
+        self.slot = worker_index if slot is None else slot
+        self.handled_list = [0] * len(self.child_output)
+
+        conf = self.app.group_conf.get(self.group_id) or dict()
+        # 分发策略需要worker在返回中带上负载信息
+        self.report_load = self.app.dispatcher_dict[self.group_id].report_load
+        self.batch_max_msgs = conf.get('batch_max_msgs', 0)
+        self.batch_max_delay_ms = conf.get('batch_max_delay_ms', 0)
+        self.concurrency = conf.get('concurrency', 1)
+        self.deadline = conf.get('deadline', 0)
+        # 自动伸缩使用的统计 [处理请求的总耗时, 处理完的请求数]，位置由slot决定
+        self._stats = self.app.group_stats_dict[self.group_id]
+        # 每个处理线程正在处理的请求的开始时间，master的watchdog读取
+        self._running = self.app.group_running_dict[self.group_id]
+        # 是否阻塞在读取child_input中，位置由slot决定
+        self._reading = self.app.group_reading_dict[self.group_id]
+
+        # 批量收到的msg里，还没有处理的部分
+        self._read_pending = deque()
+        # 还没有发送的返回
+        self._write_batch = []
+        self._write_batch_time = None
+
+        # 多线程处理时使用
+        self._read_lock = Lock()
+        self._write_lock = Lock()
+        self._first_request_lock = Lock()
+
+        # 本地统计，定期发给master
+        self.metrics = Metrics()
+        self._metrics_labels = (('group', self.group_id),)
+
+        self.profiler = Profiler('worker-%s-%s' % (self.group_id, self.worker_index), self.app.profile_dir)
+
+        # 准备好处理请求之后设置，平滑重启时master等待这个事件
+        self.ready_event = Event()
+        # 操作和其他进程共用的队列、共享内存时持有，master强制结束worker之前先占住，见 Melon._terminate_worker
+        # 每次启动进程时由master重新创建
+        self.ipc_lock = ProcessLock()
+        # 收到master的stop消息之后，处理完已经读取的请求就退出
+        self._stopping = False
 
     def run(self):
         setproctitle.setproctitle(self.app.make_proc_name('worker:%s' % self.group_id))
         self._handle_signals()
 
+        if self.generation and self.app.reload_modules:
+            self._reload_modules()
+
         self.app.events.create_worker(self)
         for bp in self.app.blueprints:
             bp.events.create_app_worker(self)
 
+        self.app.build_dispatch_tables()
+
+        if self.app.metrics_report_interval > 0:
+            thread = Thread(target=self._report_metrics_loop)
+            thread.daemon = True
+            thread.start()
+
+        thread_list = []
+        for it in xrange(1, self.concurrency):
+            thread = Thread(target=self._handle_loop, args=(it,))
+            thread.daemon = True
+            thread.start()
+            thread_list.append(thread)
+
+        self.ready_event.set()
+        self._handle_loop()
+
+        if self._stopping:
+            # 平滑退出，等其他线程处理完
+            for thread in thread_list:
+                thread.join()
+            self._flush_write_batch()
+            logger.error('worker stopped. %s', self)
+
+    def _handle_loop(self, thread_index=0):
+        """
+        读取并处理请求，concurrency 大于1时会在多个线程中同时执行
+        :param thread_index: 处理线程的序号
+        """
+        running_index = self.slot * self.concurrency + thread_index
+
         while 1:
             try:
                 msg = self.read()
@@ -43,18 +150,74 @@ class Worker(object):
                 logger.error('exc occur.', exc_info=True)
                 break
 
+            if msg is None:
+                # 需要退出
+                break
+
+            begin_time = self._running[running_index] = time.time()
+            request = None
+            profile_token = None
             try:
                 request = self.app.request_class(self, msg)
+                if self.profiler.active:
+                    profile_token = self.profiler.begin_request(request.endpoint or self._get_cmd_label(request))
                 self._handle_request(request)
             except:
                 logger.error('exc occur. msg: %r', msg, exc_info=True)
+            self._running[running_index] = 0
+
+            if profile_token is not None:
+                self.profiler.end_request(profile_token)
+
+            duration = time.time() - begin_time
+            self.metrics.observe('melon_request_duration_seconds', duration,
+                                 self._metrics_labels + (('cmd', self._get_cmd_label(request)),))
+            self.metrics.incr('melon_worker_handled_total', self._metrics_labels)
+
+            with self._write_lock:
+                self.handled_list[self._get_output_index(msg)] += 1
+                self._stats[self.slot * 2] += duration
+                self._stats[self.slot * 2 + 1] += 1
+
+            if self._write_batch and (not self._read_pending or self._is_write_batch_expired()):
+                # 这一批请求处理完了，或者等待太久，就把返回一起发出去
+                self._flush_write_batch()
 
     def read(self):
         """
         读取消息
-        :return:
+        :return: 需要退出时返回None
         """
-        return self.child_input.get()
+        with self._read_lock:
+            while 1:
+                if self._stopping:
+                    return None
+
+                if self._read_pending:
+                    msg = self._read_pending.popleft()
+                else:
+                    msg = self._get_input()
+                    if isinstance(msg, list):
+                        # master 批量发送过来的
+                        self._read_pending.extend(msg)
+                        msg = self._read_pending.popleft()
+
+                if isinstance(msg, dict) and 'ctrl' in msg:
+                    self._handle_ctrl_msg(msg)
+                    continue
+
+                break
+
+        if isinstance(msg, str):
+            # compact_msg 模式
+            msg = envelope.unpack(msg)
+
+        if 'shm' in msg:
+            # 读取之后立即释放
+            with self.ipc_lock:
+                msg['data'] = self.app.shm_arena.get(msg.pop('shm'))
+
+        return msg
 
     def write(self, msg):
         """
@@ -62,21 +225,206 @@ class Worker(object):
         :param msg:
         :return:
         """
+        output_index = self._get_output_index(msg)
 
-        self.app.events.before_response(self, msg)
-        for bp in self.app.blueprints:
-            bp.events.before_app_response(self, msg)
+        if self.report_load:
+            msg['worker_index'] = self.worker_index
+            msg['generation'] = self.generation
+            msg['handled'] = self.handled_list[output_index]
+
+        for handler in self.app.hook_table['before_response']:
+            handler(self, msg)
+
+        out_msg = msg
+        shm_arena = self.app.shm_arena
+        if shm_arena and len(msg.get('data') or '') >= self.app.shm_payload_threshold:
+            with self.ipc_lock:
+                handle = shm_arena.put(msg['data'])
+            if handle:
+                out_msg = dict(msg, data=None, shm=handle)
+                self.metrics.incr('melon_shm_payloads_total', self._metrics_labels + (('direction', 'response'),))
 
+        data = envelope.pack(out_msg) if self.app.compact_msg else out_msg
+
+        if self.batch_max_msgs > 1:
+            # 先缓存起来，由 run 统一发送
+            with self._write_lock:
+                self._write_batch.append((output_index, data))
+                if len(self._write_batch) == 1:
+                    self._write_batch_time = time.time()
+                batch_full = len(self._write_batch) >= self.batch_max_msgs
+
+            if batch_full:
+                result = self._flush_write_batch()
+            else:
+                result = True
+        else:
+            try:
+                self._put_queue(self.child_output[output_index], data)
+                result = True
+            except:
+                logger.error('exc occur. msg: %r', msg, exc_info=True)
+                self.metrics.incr('melon_worker_write_failed_total', self._metrics_labels)
+                if shm_arena:
+                    with self.ipc_lock:
+                        release_msgs(shm_arena, data)
+                result = False
+
+        for handler in self.app.hook_table['after_response']:
+            handler(self, msg, result)
+
+        return result
+
+    def invalidate_cache(self, key=None, prefix=None):
+        """
+        通知master删除返回缓存，多acceptor时发给所有acceptor
+        在返回之前调用，master会先处理删除
+        """
+        msg = dict(ctrl='cache_invalidate', key=key, prefix=prefix)
+
+        result = True
+        for queue in self.child_output:
+            try:
+                self._put_queue(queue, msg)
+            except:
+                logger.error('exc occur. msg: %r', msg, exc_info=True)
+                result = False
+
+        return result
+
+    def _handle_ctrl_msg(self, msg):
+        """
+        处理master发来的控制消息
+        """
+        if msg['ctrl'] != 'stop':
+            logger.error('invalid ctrl msg: %r', msg)
+            return
+
+        if msg['pid'] == os.getpid() and msg['slot'] == self.slot:
+            self._stopping = True
+            return
+
+        if time.time() >= msg['expire_time']:
+            # 对方已经被master强制结束
+            return
+
+        # 共用队列时，可能读到发给其他worker的，对方还在运行的话放回去
         try:
-            self.child_output.put_nowait(msg)
-            result = True
-        except:
-            logger.error('exc occur. msg: %r', msg, exc_info=True)
-            result = False
+            os.kill(msg['pid'], 0)
+        except OSError:
+            return
 
-        for bp in self.app.blueprints:
-            bp.events.after_app_response(self, msg, result)
-        self.app.events.after_response(self, msg, result)
+        time.sleep(0.001)
+        self._put_queue(self.child_input, msg)
+
+    def _get_input(self):
+        """
+        从child_input读取，阻塞时会一直持有队列的读锁
+        先在ipc_lock中标记为读取中，master看到标记就不会强制结束这个worker
+        """
+        with self.ipc_lock:
+            self._reading[self.slot] = 1
+
+        try:
+            return self.child_input.get()
+        finally:
+            self._reading[self.slot] = 0
+
+    def _put_queue(self, queue, msg):
+        """
+        写入和其他进程共用的队列
+        """
+        with self.ipc_lock:
+            queue.put_nowait(msg)
+
+    def _reload_modules(self):
+        """
+        重新加载 app.reload_modules
+        已注册的view_func和回调替换为新模块中的同名函数，新模块重复注册到app上的回调只保留一个
+        """
+        modules = dict()
+        for name in self.app.reload_modules:
+            module = sys.modules.get(name)
+            modules[name] = reload(module) if module else importlib.import_module(name)
+
+        for routes in [self.app] + self.app.blueprints:
+            for route_rule in routes.rule_map.values():
+                view_func = route_rule['view_func']
+                module = modules.get(view_func.__module__)
+                new_view_func = getattr(module, view_func.__name__, None) if module else None
+                if callable(new_view_func):
+                    route_rule['view_func'] = new_view_func
+
+        for events in [self.app.events] + [bp.events for bp in self.app.blueprints]:
+            for slot in events:
+                handler_list = []
+                handler_keys = set()
+                for handler in slot.targets:
+                    module = modules.get(handler.__module__)
+                    if module is None:
+                        handler_list.append(handler)
+                        continue
+
+                    key = (handler.__module__, handler.__name__)
+                    if key in handler_keys:
+                        continue
+                    handler_keys.add(key)
+
+                    new_handler = getattr(module, handler.__name__, None)
+                    handler_list.append(safe_func(new_handler) if callable(new_handler) else handler)
+                slot.targets[:] = handler_list
+
+        logger.error('modules reloaded: %s', modules.keys())
+
+    def _get_output_index(self, msg):
+        """
+        返回给连接所属的acceptor
+        """
+        if len(self.child_output) == 1:
+            return 0
+
+        return get_acceptor_index(msg.get('conn_id') or 0)
+
+    def _is_write_batch_expired(self):
+        """
+        batch_max_delay_ms 为0时不按时间发送，只在这一批请求处理完之后发送
+        """
+        if self.batch_max_delay_ms <= 0:
+            return False
+
+        write_batch_time = self._write_batch_time
+        return write_batch_time is not None and \
+            time.time() - write_batch_time >= self.batch_max_delay_ms / 1000.0
+
+    def _flush_write_batch(self):
+        """
+        把缓存的返回一次性发给master
+        :return: 是否成功
+        """
+        with self._write_lock:
+            batch = self._write_batch
+            if not batch:
+                return True
+
+            self._write_batch = []
+            self._write_batch_time = None
+
+        output_dict = dict()
+        for output_index, data in batch:
+            output_dict.setdefault(output_index, []).append(data)
+
+        result = True
+        for output_index, data_list in output_dict.items():
+            try:
+                # list 代表一批msg，master端会自动拆开
+                self._put_queue(self.child_output[output_index], data_list if len(data_list) > 1 else data_list[0])
+            except:
+                logger.error('exc occur. batch len: %s', len(data_list), exc_info=True)
+                self.metrics.incr('melon_worker_write_failed_total', self._metrics_labels, len(data_list))
+                if self.app.shm_arena:
+                    with self.ipc_lock:
+                        release_msgs(self.app.shm_arena, data_list)
+                result = False
 
         return result
 
@@ -93,18 +441,28 @@ class Worker(object):
             request.write(dict(ret=constants.RET_INVALID_CMD))
             return False
 
+        deadline = request.deadline
+        if deadline and request.recv_time and time.time() - request.recv_time > deadline:
+            # 客户端很可能已经超时，不再处理
+            self.metrics.incr('melon_deadline_exceeded_total',
+                              self._metrics_labels + (('cmd', self._get_cmd_label(request)),))
+            request.write(dict(ret=constants.RET_DEADLINE_EXCEEDED))
+            return False
+
         if not self.app.got_first_request:
-            self.app.got_first_request = True
+            # 多线程时，其他请求要等第一个请求的回调执行完
+            with self._first_request_lock:
+                if not self.app.got_first_request:
+                    for handler in self.app.hook_table['before_first_request']:
+                        handler(request)
 
-            self.app.events.before_first_request(request)
-            for bp in self.app.blueprints:
-                bp.events.before_app_first_request(request)
+                    self.app.got_first_request = True
 
-        self.app.events.before_request(request)
-        for bp in self.app.blueprints:
-            bp.events.before_app_request(request)
-        if request.blueprint:
-            request.blueprint.events.before_request(request)
+        route_entry = request.route_entry
+
+        # 已经按顺序展开: app、所有blueprint的before_app_request、所属blueprint的before_request
+        for handler in route_entry['before_request']:
+            handler(request)
 
         if request.interrupted:
             # 业务要求中断
@@ -118,16 +476,40 @@ class Worker(object):
             logger.error('view_func raise exception. request: %s, e: %s',
                          request, e, exc_info=True)
             view_func_exc = e
+            self.metrics.incr('melon_view_exceptions_total',
+                              self._metrics_labels + (('cmd', self._get_cmd_label(request)),))
             request.write(dict(ret=constants.RET_INTERNAL))
 
-        if request.blueprint:
-            request.blueprint.events.after_request(request, view_func_exc)
-        for bp in self.app.blueprints:
-            bp.events.after_app_request(request, view_func_exc)
-        self.app.events.after_request(request, view_func_exc)
+        for handler in route_entry['after_request']:
+            handler(request, view_func_exc)
 
         return True
 
+    def _get_cmd_label(self, request):
+        """
+        指标中的cmd，只有注册了路由的cmd单独统计，其他的都为invalid，避免客户端发来的任意cmd让指标无限增长
+        """
+        if request is None or not request.route_rule:
+            return 'invalid'
+
+        return request.cmd
+
+    def _report_metrics_loop(self):
+        """
+        定期把统计的增量发给master，多acceptor时只发给acceptor 0
+        """
+        while 1:
+            time.sleep(self.app.metrics_report_interval)
+
+            snapshot = self.metrics.pop_snapshot()
+            if not snapshot:
+                continue
+
+            try:
+                self._put_queue(self.child_output[0], dict(ctrl='metrics', metrics=snapshot))
+            except:
+                logger.error('exc occur.', exc_info=True)
+
     def _handle_signals(self):
         """
         因为主进程的reactor重新处理了SIGINT，会导致子进程也会响应，改为SIG_IGN之后，就可以保证父进程先退出，之后再由父进程term所有的子进程
@@ -135,6 +517,29 @@ class Worker(object):
         """
         signal.signal(signal.SIGTERM, signal.SIG_DFL)
         signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # 继承自master，worker自己的子进程退出时不需要通知master
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(self.app.reload_signal, signal.SIG_IGN)
+        signal.set_wakeup_fd(-1)
+        signal.signal(self.app.profile_signal, self._on_profile_signal)
+
+    def _on_profile_signal(self, signum, frame):
+        """
+        开始统计，到时间之后在单独的线程中结束并输出，不阻塞请求的处理
+        """
+        mode, duration = self.app.get_profile_args()
+
+        try:
+            if not self.profiler.start(mode, self.app.profile_sample_interval):
+                return
+        except:
+            logger.error('exc occur.', exc_info=True)
+            return
+
+        timer = Timer(duration, self.profiler.stop)
+        timer.daemon = True
+        timer.start()
 
     def __repr__(self):
-        return 'worker. group_id: %s' % self.group_id
+        return 'worker. group_id: %s, worker_index: %s, generation: %s' % (
+            self.group_id, self.worker_index, self.generation)
@@ -7,6 +7,10 @@ setup(
     platforms='any',
     packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
     install_requires=['twisted', 'events', 'setproctitle'],
+    extras_require={
+        # asyncio frontend, python2 下使用 trollius
+        'asyncio': ['trollius'],
+    },
     url="https://github.com/dantezhu/melon",
     license="MIT",
     author="dantezhu",
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from melon.dispatcher import LeastLoadedDispatcher
+
+
+class FakeQueue(object):
+
+    def qsize(self):
+        return 0
+
+
+def make_response(worker_index, generation, handled):
+    return dict(worker_index=worker_index, generation=generation, handled=handled)
+
+
+class LeastLoadedDispatcherTest(unittest.TestCase):
+
+    def test_reload_resets_outstanding(self):
+        dispatcher = LeastLoadedDispatcher(2, FakeQueue)
+
+        for it in xrange(100):
+            dispatcher.on_dispatch(0)
+        dispatcher.on_response(make_response(0, 0, 100))
+
+        # 平滑重启之后，新的worker从0开始计数
+        for it in xrange(10):
+            dispatcher.on_dispatch(0)
+        dispatcher.on_response(make_response(0, 1, 10))
+        self.assertEqual(dispatcher.get_outstanding(0), 0)
+        self.assertEqual(dispatcher.select(None, None), 0)
+
+    def test_old_generation_drains_after_reload(self):
+        dispatcher = LeastLoadedDispatcher(1, FakeQueue)
+
+        for it in xrange(10):
+            dispatcher.on_dispatch(0)
+        dispatcher.on_response(make_response(0, 0, 2))
+        dispatcher.on_response(make_response(0, 1, 3))
+        # 旧的worker处理完已经读取的请求再退出
+        dispatcher.on_response(make_response(0, 0, 7))
+        self.assertEqual(dispatcher.get_outstanding(0), 0)
+
+    def test_fold_old_generations(self):
+        dispatcher = LeastLoadedDispatcher(1, FakeQueue)
+
+        for generation in xrange(5):
+            for it in xrange(10):
+                dispatcher.on_dispatch(0)
+            dispatcher.on_response(make_response(0, generation, 8))
+
+        self.assertEqual(len(dispatcher.handled_list[0]), 2)
+        self.assertEqual(dispatcher.get_outstanding(0), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
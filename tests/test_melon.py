@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+from multiprocessing import Process, Event
+from multiprocessing.queues import Queue
+
+from netkit.box import Box
+
+from melon import Melon
+from melon.worker import Worker
+
+
+def make_app(**conf):
+    conf.setdefault('count', 1)
+    app = Melon(Box, {1: conf}, lambda box: 1)
+    app._init_groups()
+    return app
+
+
+def read_and_handle(worker, read_event):
+    worker._get_input()
+    read_event.set()
+    # 处理请求中
+    time.sleep(60)
+
+
+class TerminateWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = make_app()
+        dispatcher = self.app.dispatcher_dict[1]
+        self.worker = Worker(self.app, 1, dispatcher.queues[0], [Queue()])
+        self.read_event = Event()
+        self.p = Process(target=read_and_handle, args=(self.worker, self.read_event))
+        self.p.daemon = True
+        self.p.start()
+
+    def tearDown(self):
+        if self.p.is_alive():
+            self.p.terminate()
+        self.p.join()
+
+    def wait_reading(self):
+        reading = self.app.group_reading_dict[1]
+        deadline = time.time() + 5
+        while not reading[self.worker.slot] and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(reading[self.worker.slot])
+
+    def test_terminate_later_when_reading(self):
+        self.wait_reading()
+
+        # 阻塞在读取中，持有队列的读锁，不能结束
+        self.assertFalse(self.app._terminate_worker(self.p, self.worker))
+        self.assertTrue(self.p.is_alive())
+        self.assertTrue(self.app._is_terminating(self.p))
+
+        # 读取完成之后，处理请求时结束
+        self.worker.child_input.put_nowait('msg')
+        self.assertTrue(self.read_event.wait(5))
+        self.app._check_terminating_workers()
+
+        self.assertFalse(self.p.is_alive())
+        self.assertFalse(self.app._is_terminating(self.p))
+
+    def test_terminate_when_holding_ipc_lock(self):
+        self.wait_reading()
+        self.worker.child_input.put_nowait('msg')
+        self.assertTrue(self.read_event.wait(5))
+
+        # 操作队列中的worker(这里由测试进程占住ipc_lock)，不能结束
+        with self.worker.ipc_lock:
+            self.assertFalse(self.app._try_terminate_worker(self.p, self.worker))
+        self.assertTrue(self.p.is_alive())
+
+        self.assertTrue(self.app._try_terminate_worker(self.p, self.worker))
+        self.assertFalse(self.p.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from netkit.box import Box
+
+from melon import Melon
+from melon.worker import Worker
+
+
+class FakeInputQueue(object):
+    """
+    依次返回items，取完之后抛出 KeyboardInterrupt 让worker的处理循环退出
+    """
+
+    def __init__(self, items):
+        self.items = list(items)
+
+    def get(self, block=True, timeout=None):
+        if not self.items:
+            raise KeyboardInterrupt
+        return self.items.pop(0)
+
+
+class FakeOutputQueue(object):
+
+    def __init__(self):
+        self.put_list = []
+
+    def put_nowait(self, obj):
+        self.put_list.append(obj)
+
+
+def make_worker(msg_list, **conf):
+    conf.setdefault('count', 1)
+    app = Melon(Box, {1: conf}, lambda box: 1)
+    # 不需要worker上报指标
+    app.metrics_report_interval = 0
+
+    @app.route(1)
+    def echo(request):
+        request.write(dict(ret=0, body=request.box.body))
+
+    app._init_groups()
+    app.build_dispatch_tables()
+
+    output = FakeOutputQueue()
+    worker = Worker(app, 1, FakeInputQueue(msg_list), [output])
+    return worker, output
+
+
+def make_msg_list(count):
+    return [dict(conn_id=i, data=Box(dict(cmd=1, sn=i, body='x%d' % i)).pack()) for i in xrange(count)]
+
+
+class WorkerWriteBatchTest(unittest.TestCase):
+
+    def test_default_delay_flushes_once_per_read_batch(self):
+        # master批量发来的10条msg，batch_max_delay_ms 为默认的0时，处理完之后一起返回
+        worker, output = make_worker([make_msg_list(10)], batch_max_msgs=16)
+        worker._handle_loop()
+
+        self.assertEqual(len(output.put_list), 1)
+        self.assertEqual(len(output.put_list[0]), 10)
+
+    def test_flush_when_batch_full(self):
+        worker, output = make_worker([make_msg_list(10)], batch_max_msgs=4)
+        worker._handle_loop()
+
+        self.assertEqual([len(it) if isinstance(it, list) else 1 for it in output.put_list], [4, 4, 2])
+
+    def test_single_msgs_are_not_delayed(self):
+        # 每次只读到一条msg时，返回不需要等待
+        worker, output = make_worker(make_msg_list(3), batch_max_msgs=16)
+        worker._handle_loop()
+
+        self.assertEqual(len(output.put_list), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()